@@ -0,0 +1,293 @@
+"""
+Headless batch analysis of many FDS files
+
+    python Batch.py /data/archive 'runs/*.fds' one.fds --workers 8 --num-fft 4096
+
+Files, globs and directories (searched for --pattern) are expanded to a
+list of files.  Each file's sound field goes to a ResultStore, and the
+rows it doesn't hold yet are split into shards of --shard-rows rows.
+One job per shard runs on a bounded process pool, the largest files
+first so a big file doesn't start last and hold up the end of the run.
+The store of a file is checkpointed as its shards complete, so an
+interrupted batch picks up where it stopped.  Nothing here imports
+Tkinter or matplotlib.
+"""
+
+import argparse
+import fnmatch
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy
+
+from NoiseFloor import NoiseFloorEstimator
+from Profiler import Profiler
+from ReadFDS import ReadFDS
+from ResultSink import ResultStore
+from SpectralAnalysis import SpectralAnalysis
+
+
+# state of a worker process, the analyzer of the file of its last job
+_worker = {}
+
+
+def find_files(paths, pattern='*.fds'):
+    """
+    Expand files, globs and directories into a list of files
+    :param paths: list of paths, glob patterns or directories
+    :param pattern: fnmatch pattern of the files taken from directories
+    :return: sorted list of unique absolute paths
+    """
+    files = set()
+
+    for path in paths:
+        matches = glob.glob(path) if glob.has_magic(path) else [path]
+
+        for match in matches:
+            if os.path.isdir(match):
+                for directory, _, names in os.walk(match):
+                    files.update(os.path.join(directory, name) for name in fnmatch.filter(names, pattern))
+            elif os.path.isfile(match):
+                files.add(match)
+            else:
+                raise Exception("Batch:FileNotFound\nNo such file or directory: {0}".format(match))
+
+    return sorted(os.path.abspath(path) for path in files)
+
+
+def get_output_path(path, output=None):
+    """
+    Directory of a file's ResultStore
+    :param path: FDS file
+    :param output: Directory for all stores, None to put each next to its file
+    :return: str
+    """
+    if output is None:
+        return path + '_processed'
+
+    return os.path.join(output, os.path.basename(path) + '_processed')
+
+
+def make_analyzer(path, settings):
+    """
+    SpectralAnalysis of a file with the batch settings applied
+    :param path: FDS file
+    :param settings: dict of the command line options, see main
+    :return: SpectralAnalysis
+    """
+    reader = ReadFDS(path, None)
+    reader.profiler = Profiler(enabled=bool(settings.get('profile')))
+    reader.read_header()
+
+    analyzer = SpectralAnalysis(reader)
+    analyzer.processor = 'CPU'  # the jobs already use every CPU
+
+    if settings.get('precision'):
+        analyzer.set_precision(settings['precision'])
+    if settings.get('num_fft'):
+        analyzer.set_num_fft(settings['num_fft'])
+    if settings.get('freq_rng'):
+        analyzer.set_freq_rng(settings['freq_rng'])
+    if settings.get('stacking'):
+        analyzer.psd_stacking_factor = settings['stacking']
+    if settings.get('engine'):
+        analyzer.spectral_engine = settings['engine']
+    if settings.get('noise_floor'):
+        analyzer.nf_estimator = NoiseFloorEstimator(settings['noise_floor'])
+    analyzer.b_save_psd = bool(settings.get('save_psd'))
+
+    if settings.get('channels'):
+        analyzer.set_roi(sp_rng=settings['channels'])
+    if settings.get('time_window'):
+        analyzer.set_time_rng(*settings['time_window'])
+    if settings.get('bin_size'):
+        analyzer.set_binning(settings['bin_size'], settings.get('bin_stride'), settings.get('bin_method') or 'mean')
+
+    return analyzer
+
+
+def init_worker(settings):
+    _worker['settings'] = settings
+    _worker['path'] = None
+
+
+def run_job(job):
+    """
+    Compute the sound field rows [first, last) of a file into its store
+    :param job: (path, store directory, first, last)
+    :return: (the job, the worker's stage times since its last job, see Profiler.take)
+    """
+    path, store_path, first, last = job
+
+    # the shards of a file mostly go to the same worker one after the
+    # other, so its analyzer and the mapped file are kept
+    if _worker['path'] != path:
+        analyzer = make_analyzer(path, _worker['settings'])
+        analyzer.num_threads = 1
+        _worker['path'] = path
+        _worker['analyzer'] = analyzer
+        _worker['data'] = analyzer.get_roi_data()
+    analyzer = _worker['analyzer']
+    data = _worker['data']
+
+    sf = numpy.load(os.path.join(store_path, ResultStore.SF_FILE), mmap_mode='r+')
+    psd = None
+    if analyzer.b_save_psd:
+        psd = numpy.load(os.path.join(store_path, ResultStore.PSD_FILE), mmap_mode='r+')
+
+    start, stop = analyzer.get_row_shots(first, last, analyzer.get_num_frames(data.shape[0]))
+    analyzer.spectrogram(data[start:stop], out=sf[first:last], psd_out=None if psd is None else psd[first:last])
+
+    # on disk before the main process checkpoints them
+    for result in (sf, psd):
+        if result is not None:
+            result.flush()
+
+    return job, analyzer.profiler.take()
+
+
+def run(paths, settings, output=None, num_workers=None, shard_rows=4096, profiler=None):
+    """
+    Analyze files on a process pool
+    :param paths: FDS files
+    :param settings: dict of analysis options, see make_analyzer
+    :param output: Directory for the stores, None to put them next to the files
+    :param num_workers: Processes, None for the number of CPUs
+    :param shard_rows: Most sound field rows in one job
+    :param profiler: Optional Profiler the stage times of every job are added to
+    :return: dict of the store directory of each file
+    """
+    if output is not None and not os.path.isdir(output):
+        os.makedirs(output)
+
+    names = [os.path.basename(path) for path in paths]
+    if output is not None and len(set(names)) < len(names):
+        raise Exception("Batch:DuplicateName\nFiles with the same name can't share an output directory")
+
+    stores = {}
+    jobs = []
+    for path in sorted(paths, key=os.path.getsize, reverse=True):
+        analyzer = make_analyzer(path, settings)
+        if profiler is not None:
+            profiler.merge(analyzer.profiler.take())
+        store = ResultStore.for_analyzer(get_output_path(path, output), analyzer)
+        stores[path] = store
+
+        if store.is_complete():
+            print("{0}: done before".format(path))
+            continue
+
+        # a running noise floor estimate needs every frame before it, it
+        # isn't saved, so an interrupted one starts over from the first row
+        num_rows = store.data.shape[0]
+        size = max(int(shard_rows), 1)
+        if analyzer.nf_estimator.stateful:
+            size = num_rows
+            store.count = 0
+        jobs += [(path, store.path, first, min(first + size, num_rows))
+                 for first in range(store.count, num_rows, size)]
+
+        # the workers open the files, they must exist on disk
+        store.checkpoint()
+
+    # rows completed out of order wait until the rows before them are done
+    finished = dict((path, {}) for path in stores)
+
+    def complete(result):
+        job, stages = result
+        if profiler is not None:
+            profiler.merge(stages)
+
+        path, _, first, last = job
+        store = stores[path]
+        finished[path][first] = last
+
+        count = store.count
+        while count in finished[path]:
+            count = finished[path].pop(count)
+        if count != store.count:
+            store.checkpoint(count)
+            if store.is_complete():
+                print("{0}: {1} rows -> {2}".format(path, count, store.path))
+
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if num_workers < 2 or len(jobs) < 2:
+        init_worker(settings)
+        for job in jobs:
+            complete(run_job(job))
+    else:
+        pool = multiprocessing.Pool(min(num_workers, len(jobs)), init_worker, (settings,))
+        try:
+            # the jobs are handed out in order, largest files first
+            for result in pool.imap_unordered(run_job, jobs):
+                complete(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    return dict((path, store.path) for path, store in stores.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute the sound field of FDS files without a display')
+    parser.add_argument('paths', nargs='+', help='FDS files, globs or directories')
+    parser.add_argument('--pattern', default='*.fds', help='files taken from directories')
+    parser.add_argument('--output', help='directory for the results, next to each file by default')
+    parser.add_argument('--workers', type=int, help='processes, the number of CPUs by default')
+    parser.add_argument('--shard-rows', type=int, default=4096, help='most sound field rows in one job')
+    parser.add_argument('--num-fft', type=int, help='shots per frame')
+    parser.add_argument('--stacking', type=int, help='frames whose PSDs are stacked into a row')
+    parser.add_argument('--freq-rng', type=float, nargs='+', help='analysis bands in Hz, start end start end ...')
+    parser.add_argument('--channels', type=int, nargs=2, help='first and last channel, 1-based')
+    parser.add_argument('--time-window', nargs=2, help="start and end, e.g. '14:02:10' '14:05:00'")
+    parser.add_argument('--bin-size', type=int, help='neighbouring channels reduced to one before the FFT')
+    parser.add_argument('--bin-stride', type=int, help='channels from one group to the next, --bin-size by default')
+    parser.add_argument('--bin-method', choices=['mean', 'rms'])
+    parser.add_argument('--precision', choices=['double', 'single'])
+    parser.add_argument('--engine', choices=['auto', 'fft', 'dft'])
+    parser.add_argument('--noise-floor', choices=['median', 'partition', 'smoothed'])
+    parser.add_argument('--save-psd', action='store_true', help='also save the PSD of the displayed range')
+    parser.add_argument('--profile', metavar='FILE', help='save the time spent in every stage as JSON')
+    args = parser.parse_args(argv)
+
+    settings = {
+        'num_fft': args.num_fft,
+        'stacking': args.stacking,
+        'freq_rng': args.freq_rng,
+        'channels': args.channels,
+        'time_window': args.time_window,
+        'bin_size': args.bin_size,
+        'bin_stride': args.bin_stride,
+        'bin_method': args.bin_method,
+        'precision': args.precision,
+        'engine': args.engine,
+        'noise_floor': args.noise_floor,
+        'save_psd': args.save_psd,
+        'profile': bool(args.profile),
+    }
+
+    paths = find_files(args.paths, args.pattern)
+    if not paths:
+        print("No files found")
+        return 1
+
+    start = time.time()
+    profiler = Profiler() if args.profile else None
+    run(paths, settings, args.output, args.workers, args.shard_rows, profiler)
+    print("{0} files in {1:.1f} s".format(len(paths), time.time() - start))
+
+    if profiler is not None:
+        profiler.write_json(args.profile, {'files': paths, 'settings': settings})
+        print(profiler.format())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
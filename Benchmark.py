@@ -0,0 +1,460 @@
+"""
+Benchmarks of the analysis steps on synthetic data
+
+    python Benchmark.py noise_floor precision header read sound_field reference
+    python Benchmark.py reference --update-reference
+
+The FDS files are written by SyntheticFds with a fixed seed to a
+temporary directory, so every run measures the same inputs.  reference
+checks the sound field of a file with known tones against
+REFERENCE_FILE, which is only rewritten with --update-reference.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+import numpy
+
+from FdsHeader import FdsHeader
+from NoiseFloor import NoiseFloorEstimator
+import ParallelProcessor
+from Profiler import Profiler
+from Program import read_frames
+from ReadFDS import ReadFDS
+from SpectralAnalysis import SpectralAnalysis
+import SyntheticFds
+
+
+# largest SNR deviation of the single precision mode, relative to the
+# largest SNR of the double precision reference
+SINGLE_PRECISION_TOLERANCE = 1e-4
+# a PSD bin within rounding of the noise floor may land on its other
+# side, moving the SNR of its channel by the bin's share of the band.
+# Only this share of the SNR values may deviate more than the tolerance,
+# and by at most SINGLE_PRECISION_FLIP_TOLERANCE
+SINGLE_PRECISION_FLIP_SHARE = 1e-3
+SINGLE_PRECISION_FLIP_TOLERANCE = 1e-2
+
+# (channels, seconds) of the files of bench_sound_field
+SOUND_FIELD_SIZES = [(64, 60), (256, 30), (1024, 10)]
+
+# sound field of the reference file, and the largest deviation from it
+# relative to its largest SNR
+REFERENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_reference.npy')
+REFERENCE_TOLERANCE = 1e-6
+
+# the reference file: fixed tones as (Hz, amplitude, first channel,
+# last channel) in noise, and the least ratio of the mean SNR of a tone
+# channel to the largest mean SNR of the channels without a tone
+REFERENCE_TONES = [(150, 3000, 8, 9), (400, 2000, 20, 20)]
+REFERENCE_CONTRAST = 2
+
+
+def make_reader(num_channels, num_shots, prf=2000, encoding='uint16'):
+    """
+    ReadFDS with a header built in memory, for analyzing arrays
+    without an FDS file
+    :return: ReadFDS
+    """
+    header = FdsHeader()
+    header.num_rows = num_channels
+    header.data_encoding = encoding
+    header.file_size = num_shots * num_channels * numpy.dtype(numpy.uint16).itemsize
+    header.values = {
+        'acquisition.laserPulseRate': str(prf),
+        'acquisition.alazar.channelA.inputRange': '2V',
+        'DataLocusCount': str(num_channels),
+        'EndShots': str(num_shots),
+        'HeaderSize_Bytes': '0',
+        'DataEncoding': encoding,
+        'PositionOfFirstSample_m': '0',
+        'TimeOfFirstSample': '2014-07-08T17:29:59.0000000Z',
+    }
+
+    reader = ReadFDS(None, None)
+    reader.header = header
+
+    return reader
+
+
+def write_file(directory, num_channels, seconds, prf=2000, encoding='uint16', **signal):
+    """
+    Write a synthetic FDS file with a fixed seed
+    :param directory: Directory of the file
+    :param signal: Options of SyntheticFds.make_shots
+    :return: path of the file
+    """
+    path = os.path.join(directory, '{0}ch_{1}s_{2}.fds'.format(num_channels, seconds, encoding))
+    SyntheticFds.write_file(path, num_channels, int(seconds * prf), prf, encoding=encoding, seed=0, **signal)
+
+    return path
+
+
+def open_file(path, profiler=None):
+    """
+    :return: SpectralAnalysis of a file, computing on this CPU
+    """
+    reader = ReadFDS(path, None)
+    if profiler is not None:
+        reader.profiler = profiler
+    reader.read_header()
+
+    analyzer = SpectralAnalysis(reader)
+    analyzer.processor = 'CPU'
+
+    return analyzer
+
+
+def stream_sound_field(analyzer):
+    """
+    Sound field of the chunked reader and process_chunk, one frame at a
+    time like Program does without the memory map
+    :return: (rows x channels) SNR
+    """
+    rows = []
+    for iteration, mat in read_frames(analyzer.reader, analyzer):
+        row = analyzer.process_chunk(iteration, mat)
+        if row is not None:
+            rows.append(row.copy())
+
+    return numpy.array(rows)
+
+
+def make_shots(num_shots, num_channels, prf=2000, tone_hz=100, seed=0):
+    """
+    uint16 shots of noise with a tone in every third channel
+    :return: (shots x channels) array
+    """
+    rng = numpy.random.RandomState(seed)
+
+    t = numpy.arange(num_shots)[:, numpy.newaxis] / float(prf)
+    tone = 300 * numpy.sin(2 * numpy.pi * tone_hz * t) * (numpy.arange(num_channels) % 3 == 0)
+    shots = 32768 + 1000 * rng.standard_normal((num_shots, num_channels)) + tone
+
+    return numpy.clip(shots, 0, 65535).astype(numpy.uint16)
+
+
+def make_noise_psd(num_frames, num_fft, num_channels, seed=0, chunk_frames=8):
+    """
+    PSD frames of white noise whose level differs between channels and
+    drifts slowly over time, like the noise region of a real capture.
+    They are made chunk_frames at a time, so the memory doesn't grow
+    with num_frames
+    :return: generator of ((frames x num_fft / 2 + 1 x channels) PSD,
+             (frames x channels) noise level) per chunk
+    """
+    rng = numpy.random.RandomState(seed)
+
+    gain = rng.uniform(0.5, 2.0, num_channels)
+    drift = 1 + 0.2 * numpy.sin(numpy.linspace(0, 2 * numpy.pi, num_frames))
+
+    for start in range(0, num_frames, chunk_frames):
+        level = gain * drift[start:start + chunk_frames, numpy.newaxis]
+        frames = rng.standard_normal((level.shape[0], num_fft, num_channels)) * numpy.sqrt(level)[:, numpy.newaxis, :]
+
+        fft = numpy.fft.rfft(frames, axis=1)
+        yield (numpy.square(fft.real) + numpy.square(fft.imag)) / num_fft, level
+
+
+def bench_noise_floor(num_frames=200, num_fft=2048, num_channels=500):
+    """
+    Time every noise floor method on one frame at a time, like
+    process_chunk does.  Errors are relative to the exact median of each
+    frame and to the true median of the noise, level * ln(2).  The
+    frames are made and estimated a chunk at a time
+    """
+    estimators = [('median', NoiseFloorEstimator('median')),
+                  ('partition', NoiseFloorEstimator('partition'))]
+    for subsample in [4, 8, 16]:
+        estimators.append(('smoothed 1/{0}'.format(subsample),
+                           NoiseFloorEstimator('smoothed', smoothing=0.1, subsample=subsample)))
+
+    # per estimator the seconds, and the sum and max of the errors
+    elapsed = dict((name, 0.0) for name, _ in estimators)
+    error_sum = dict((name, 0.0) for name, _ in estimators)
+    error_max = dict((name, 0.0) for name, _ in estimators)
+    true_error_sum = dict((name, 0.0) for name, _ in estimators)
+
+    num_bins = None
+    for psd, level in make_noise_psd(num_frames, num_fft, num_channels):
+        region = psd[:, (-num_fft // 4):-2, :]
+        num_bins = region.shape[1]
+        exact = numpy.median(region, axis=-2)
+        true = level * numpy.log(2)
+
+        for name, estimator in estimators:
+            estimate = numpy.empty_like(exact)
+
+            start = time.time()
+            for i in range(region.shape[0]):
+                estimate[i] = estimator.estimate(region[i])
+            elapsed[name] += time.time() - start
+
+            error = numpy.abs(estimate - exact) / exact
+            error_sum[name] += error.sum()
+            error_max[name] = max(error_max[name], error.max())
+            true_error_sum[name] += (numpy.abs(estimate - true) / true).sum()
+
+    print("noise floor, {0} frames x {1} bins x {2} channels".format(num_frames, num_bins, num_channels))
+    print("{0:<24}{1:>12}{2:>16}{3:>16}{4:>16}".format('method', 'ms / frame', 'mean rel err',
+                                                       'max rel err', 'vs true median'))
+
+    count = float(num_frames * num_channels)
+    for name, _ in estimators:
+        print("{0:<24}{1:>12.3f}{2:>16.2e}{3:>16.2e}{4:>16.2e}".format(name, 1000 * elapsed[name] / num_frames,
+                                                                   error_sum[name] / count, error_max[name],
+                                                                   true_error_sum[name] / count))
+
+
+def validate_precision(num_shots=200000, num_channels=64):
+    """
+    Compare the single precision mode with the double precision
+    reference and fail if the SNR deviates more than
+    SINGLE_PRECISION_TOLERANCE, or if the spectrum and PSD of the
+    single precision mode aren't complex64 and float32
+    """
+    reader = make_reader(num_channels, num_shots)
+    shots = make_shots(num_shots, num_channels)
+
+    results = {}
+    for precision in ['double', 'single']:
+        analyzer = SpectralAnalysis(reader)
+        analyzer.processor = 'CPU'
+        analyzer.set_precision(precision)
+
+        frames = analyzer.decoder.decode(shots[:2 * analyzer.num_fft]).reshape(
+            (2, analyzer.num_fft, num_channels))
+        spectrum, psd = analyzer.get_spectrum(frames), analyzer.get_psd(frames)
+        if precision == 'single' and (spectrum.dtype != numpy.complex64 or psd.dtype != numpy.float32):
+            raise Exception("Benchmark:PrecisionError\n"
+                            "The single precision spectrum is {0} and its PSD {1}, a single precision FFT "
+                            "needs numpy 2.0 or scipy".format(spectrum.dtype, psd.dtype))
+
+        start = time.time()
+        results[precision] = analyzer.spectrogram(shots)
+        elapsed = time.time() - start
+
+        print("{0:<8}{1:>10.3f} s  {2}".format(precision, elapsed, results[precision].dtype))
+
+    deviations = numpy.abs(results['single'] - results['double']) / numpy.abs(results['double']).max()
+    deviation = deviations.max()
+    flipped = numpy.count_nonzero(deviations > SINGLE_PRECISION_TOLERANCE)
+    print("max SNR deviation {0:.2e} (tolerance {1:.0e}), {2} of {3} values beyond it".format(
+        deviation, SINGLE_PRECISION_TOLERANCE, flipped, deviations.size))
+
+    if flipped > SINGLE_PRECISION_FLIP_SHARE * deviations.size or deviation > SINGLE_PRECISION_FLIP_TOLERANCE:
+        raise Exception("Benchmark:PrecisionError\n"
+                        "Single precision SNR deviates {0:.2e} from double precision".format(deviation))
+
+
+def bench_header(repeat=200):
+    """
+    Time FdsHeader.process on the header of a synthetic file
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = write_file(directory, 64, 1)
+
+        start = time.time()
+        for _ in range(repeat):
+            FdsHeader(debug=False).process(path)
+        elapsed = time.time() - start
+
+        print("header parse {0:.3f} ms".format(1000 * elapsed / repeat))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_read(num_channels=256, seconds=60, chunk_bytes=1 << 20):
+    """
+    Raw read throughput of the ways ReadFDS gets at the data section.
+    The file was just written, so it is likely in the page cache and
+    this measures the cost of the reads, not of the disk
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        path = write_file(directory, num_channels, seconds)
+        analyzer = open_file(path)
+        reader = analyzer.reader
+        start_loc = reader.header.data_start_loc
+        size = reader.header.file_size - start_loc
+
+        def read_chunks():
+            for _ in reader.read_chunks(start_loc, chunk_bytes):
+                pass
+
+        def prefetch_chunks():
+            for _ in reader.prefetch_chunks(start_loc, chunk_bytes):
+                pass
+
+        def map_data():
+            # every page is touched
+            reader.map_data().max()
+
+        print("read {0:.1f} MB, {1} channels".format(size / 1e6, num_channels))
+        for name, read in [('read_chunks', read_chunks), ('prefetch_chunks', prefetch_chunks),
+                           ('map_data', map_data)]:
+            start = time.time()
+            read()
+            elapsed = time.time() - start
+            print("{0:<20}{1:>10.3f} s{2:>12.1f} MB/s".format(name, elapsed, size / 1e6 / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+def get_peak_rss():
+    """
+    :return: peak resident memory of this process in bytes, None where
+             the resource module is missing
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_sound_field(path, mode):
+    """
+    One run of bench_sound_field.  It runs in an interpreter of its own,
+    started by bench_sound_field, so the peak memory is that of the run
+    :param mode: 'sound field' or 'process_chunk'
+    :return: dict of the timing and memory
+    """
+    base_rss = get_peak_rss()
+
+    profiler = Profiler()
+    analyzer = open_file(path, profiler)
+    if mode == 'process_chunk':
+        stream_sound_field(analyzer)
+    else:
+        analyzer.compute_sound_field()
+
+    report = profiler.report()
+    return {
+        'wall_seconds': report['wall_seconds'],
+        'frames_per_s': report['frames_per_s'],
+        'bytes': analyzer.reader.header.file_size - analyzer.reader.header.data_start_loc,
+        'base_rss_bytes': base_rss,
+        'peak_rss_bytes': get_peak_rss(),
+    }
+
+
+def bench_sound_field(sizes=None):
+    """
+    End-to-end throughput and peak memory of the batched sound field
+    (compute_sound_field) and of process_chunk over the chunked reader,
+    for files of every size in SOUND_FIELD_SIZES.  'base MB' is the peak
+    resident memory of the interpreter with the modules loaded, 'peak MB'
+    that at the end of the run
+    """
+    print("{0:<16}{1:>10}{2:>10}{3:>12}{4:>12}{5:>12}{6:>12}{7:>12}".format(
+        'mode', 'channels', 'seconds', 's', 'MB/s', 'frames/s', 'base MB', 'peak MB'))
+
+    def format_mb(nbytes):
+        return 'n/a' if nbytes is None else '{0:.1f}'.format(nbytes / 1e6)
+
+    directory = tempfile.mkdtemp()
+    try:
+        for num_channels, seconds in sizes or SOUND_FIELD_SIZES:
+            path = write_file(directory, num_channels, seconds)
+
+            for mode in ['sound field', 'process_chunk']:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                                  '--run-sound-field', path, mode])
+                result = json.loads(output.decode('ascii').splitlines()[-1])
+
+                print("{0:<16}{1:>10}{2:>10}{3:>12.3f}{4:>12.1f}{5:>12.0f}{6:>12}{7:>12}".format(
+                    mode, num_channels, seconds, result['wall_seconds'],
+                    result['bytes'] / 1e6 / result['wall_seconds'], result['frames_per_s'],
+                    format_mb(result['base_rss_bytes']), format_mb(result['peak_rss_bytes'])))
+            os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def validate_reference(num_channels=32, seconds=30, update=False):
+    """
+    Check the sound field of a file with known tones: the batched,
+    streamed and multi-process paths must agree, the tone channels must
+    stand out and the rows must match REFERENCE_FILE
+    :param update: Write the sound field to REFERENCE_FILE instead of
+                   comparing it, e.g. after an intended change of the results
+    """
+    if not update and not os.path.exists(REFERENCE_FILE):
+        raise Exception("Benchmark:ReferenceError\n"
+                        "{0} is missing, write it with --update-reference".format(REFERENCE_FILE))
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = write_file(directory, num_channels, seconds, amplitude=0, tones=REFERENCE_TONES)
+
+        sf = open_file(path).compute_sound_field()
+        results = [('process_chunk', stream_sound_field(open_file(path))),
+                   ('N-CPU', ParallelProcessor.spectrogram(open_file(path), 2))]
+    finally:
+        shutil.rmtree(directory)
+
+    scale = numpy.abs(sf).max()
+    for name, result in results:
+        if result.shape != sf.shape or numpy.abs(result - sf).max() > REFERENCE_TOLERANCE * scale:
+            raise Exception("Benchmark:ReferenceError\n"
+                            "The sound field of {0} differs from compute_sound_field".format(name))
+
+    tone = numpy.zeros(num_channels, dtype=bool)
+    for _, _, first, last in REFERENCE_TONES:
+        tone[first:last + 1] = True
+    mean = sf.mean(axis=0)
+    contrast = mean[tone].min() / mean[~tone].max()
+    print("{0} rows, tone channels {1:.1f}x the other channels (at least {2})".format(
+        sf.shape[0], contrast, REFERENCE_CONTRAST))
+    if contrast < REFERENCE_CONTRAST:
+        raise Exception("Benchmark:ReferenceError\nThe tone channels don't stand out of the noise")
+
+    if update:
+        numpy.save(REFERENCE_FILE, sf)
+        print("saved the reference to {0}".format(REFERENCE_FILE))
+        return
+
+    reference = numpy.load(REFERENCE_FILE)
+    deviation = numpy.abs(sf - reference).max() / numpy.abs(reference).max() \
+        if sf.shape == reference.shape else numpy.inf
+    print("max deviation from the reference {0:.2e} (tolerance {1:.0e})".format(deviation, REFERENCE_TOLERANCE))
+    if deviation > REFERENCE_TOLERANCE:
+        raise Exception("Benchmark:ReferenceError\n"
+                        "The sound field deviates {0:.2e} from {1}".format(deviation, REFERENCE_FILE))
+
+
+BENCHMARKS = {
+    'noise_floor': bench_noise_floor,
+    'precision': validate_precision,
+    'header': bench_header,
+    'read': bench_read,
+    'sound_field': bench_sound_field,
+    'reference': validate_reference,
+}
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run-sound-field']:
+        # a single run of bench_sound_field, reported as JSON
+        print(json.dumps(run_sound_field(*sys.argv[2:4])))
+        sys.exit()
+
+    names = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    for name in names or sorted(BENCHMARKS):
+        if name == 'reference':
+            validate_reference(update='--update-reference' in sys.argv)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,96 @@
+"""
+Spatial binning of neighbouring channels
+"""
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+class ChannelBinner(object):
+    """
+    Reduce groups of `size` neighbouring channels to one, a group
+    starting every `stride` channels.  With stride < size the groups
+    overlap, with stride > size channels between them are skipped.  Only
+    complete groups are made, trailing channels that don't fill one are
+    dropped.
+
+    'mean'  average of the samples of a group, keeps the signal and
+            lowers uncorrelated noise by sqrt(size)
+    'rms'   root mean square of the samples of a group
+
+    The groups are a strided view of the samples, so nothing is copied
+    before the reduction.  Applied right after decoding, every step
+    after it works on size / stride times fewer channels.
+    """
+
+    METHODS = ['mean', 'rms']
+
+    def __init__(self, size=1, stride=None, method='mean'):
+        """
+        :param size: Channels in a group
+        :param stride: Channels from the start of a group to the next,
+                       defaults to size for groups side by side
+        :param method: 'mean' or 'rms'
+        """
+        if method not in self.METHODS:
+            raise Exception("ChannelBinner:UnknownMethod\n"
+                            "Unknown binning method '{0}', use one of {1}".format(method, self.METHODS))
+        if int(size) < 1 or (stride is not None and int(stride) < 1):
+            raise Exception("ChannelBinner:InvalidSize\nsize and stride must be at least 1")
+
+        self.size = int(size)
+        self.stride = self.size if stride is None else int(stride)
+        self.method = method
+
+    @property
+    def enabled(self):
+        """
+        Whether binning changes the channels at all
+        """
+        return self.size != 1 or self.stride != 1
+
+    def get_num_bins(self, num_channels):
+        """
+        :param num_channels: Channels before binning
+        :return: number of complete groups
+        """
+        return max((int(num_channels) - self.size) // self.stride + 1, 0)
+
+    def get_channel_rng(self, first_bin, last_bin):
+        """
+        Channels the groups [first_bin, last_bin) are made of
+        :return: [first, last) channels
+        """
+        return first_bin * self.stride, (last_bin - 1) * self.stride + self.size
+
+    def get_centers(self, num_channels):
+        """
+        :param num_channels: Channels before binning
+        :return: (bins,) fractional channel at the middle of each group
+        """
+        return numpy.arange(self.get_num_bins(num_channels)) * self.stride + (self.size - 1) / 2.0
+
+    def bin(self, samples, out=None):
+        """
+        Bin the channels of an array
+        :param samples: (..., channels) array
+        :param out: Optional (..., bins) array to write to
+        :return: (..., bins) array
+        """
+        num_bins = self.get_num_bins(samples.shape[-1])
+        if num_bins == 0:
+            raise Exception("ChannelBinner:TooFewChannels\n"
+                            "{0} channels don't fill a group of {1}".format(samples.shape[-1], self.size))
+
+        if self.method == 'rms':
+            samples = numpy.square(samples[..., :self.get_channel_rng(0, num_bins)[1]])
+
+        step = samples.strides[-1]
+        groups = as_strided(samples, shape=samples.shape[:-1] + (num_bins, self.size),
+                            strides=samples.strides[:-1] + (step * self.stride, step), writeable=False)
+
+        out = numpy.mean(groups, axis=-1, out=out)
+        if self.method == 'rms':
+            numpy.sqrt(out, out=out)
+
+        return out
@@ -0,0 +1,52 @@
+"""
+Convert raw FDS samples to volts
+"""
+
+import numpy
+
+from ReadFDS import get_data_type
+
+
+class DataDecoder(object):
+    """
+    Decode raw samples of an FDS data section into calibrated volts in a
+    single pass, optionally into a buffer that is reused between chunks.
+
+    uint16 samples are offset binary over the DAQ card's input range,
+    code 32768 is 0V.  They are scaled while numpy casts them, straight
+    into the output, and shifted in place, so no temporary arrays are
+    made.  Float samples are taken to be in volts already and only have
+    their NaNs cleaned.
+    """
+
+    def __init__(self, encoding, volt_range, dtype=numpy.float64):
+        self.data_type = get_data_type(encoding)
+        self.volt_range = float(volt_range)
+        self.dtype = numpy.dtype(dtype)
+
+        # volts per code of integer samples
+        self.scale = self.dtype.type(self.volt_range / 32768)
+
+    def decode(self, raw, out=None):
+        """
+        Decode raw samples
+        :param raw: numpy array of samples, or a buffer of raw bytes
+        :param out: Optional array of self.dtype to write to, same shape as raw
+        :return: array of volts
+        """
+        if not isinstance(raw, numpy.ndarray):
+            raw = numpy.frombuffer(raw, dtype=self.data_type)
+
+        if out is None:
+            out = numpy.empty(raw.shape, dtype=self.dtype)
+
+        if self.data_type == numpy.uint16:
+            numpy.multiply(raw, self.scale, out=out)
+            out -= self.dtype.type(self.volt_range)
+        else:
+            numpy.copyto(out, raw, casting='same_kind')
+
+            # convert bad values to zero, this is done in MATLAB as well
+            numpy.nan_to_num(out, copy=False)
+
+        return out
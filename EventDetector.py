@@ -0,0 +1,314 @@
+"""
+Sparse detection of events in the SNR rows of the sound field
+
+Instead of keeping the (rows x channels) sound field, every row is
+thresholded as it is computed and only the events are kept: runs of
+channels above the threshold, followed from row to row while they
+overlap.  A channel turns on at on_threshold and only turns off below
+off_threshold, so an SNR flickering around the threshold doesn't split
+an event.  Events shorter than min_rows are dropped.  The detector holds
+one row of state and the events in progress, so its memory grows with
+the number of events, not with the length of the capture.
+"""
+
+import numpy
+
+
+class Event(object):
+    """
+    A detection in one analysis band, over a range of rows and channels.
+    Channels are 0-based in the ROI, rows are sound field rows
+    """
+
+    __slots__ = ('band', 'first_row', 'last_row', 'first_channel', 'last_channel',
+                 'peak_snr', 'peak_row', 'peak_channel',
+                 'start_time', 'end_time', 'peak_time', 'start_distance', 'end_distance', 'peak_distance',
+                 'row_first_channel', 'row_last_channel')
+
+    def __init__(self, band, row, first_channel, last_channel, peak_snr, peak_channel):
+        self.band = band
+        self.first_row = self.last_row = self.peak_row = row
+        self.first_channel = self.row_first_channel = first_channel
+        self.last_channel = self.row_last_channel = last_channel
+        self.peak_snr = peak_snr
+        self.peak_channel = peak_channel
+        self.start_time = self.end_time = self.peak_time = None
+        self.start_distance = self.end_distance = self.peak_distance = None
+
+    def add(self, row, first_channel, last_channel, peak_snr, peak_channel):
+        """
+        Extend the event with channels of a row, or with another event
+        """
+        if self.last_row != row:
+            # the channels of the newest row, which the next row must overlap
+            self.row_first_channel, self.row_last_channel = first_channel, last_channel
+        else:
+            self.row_first_channel = min(self.row_first_channel, first_channel)
+            self.row_last_channel = max(self.row_last_channel, last_channel)
+
+        self.last_row = max(self.last_row, row)
+        self.first_channel = min(self.first_channel, first_channel)
+        self.last_channel = max(self.last_channel, last_channel)
+
+        if peak_snr > self.peak_snr:
+            self.peak_snr = peak_snr
+            self.peak_row = row
+            self.peak_channel = peak_channel
+
+    def merge(self, other):
+        """
+        Add another event that turned out to be part of this one
+        """
+        self.first_row = min(self.first_row, other.first_row)
+        if other.peak_snr > self.peak_snr:
+            self.peak_snr, self.peak_row, self.peak_channel = other.peak_snr, other.peak_row, other.peak_channel
+        self.first_channel = min(self.first_channel, other.first_channel)
+        self.last_channel = max(self.last_channel, other.last_channel)
+        if other.last_row == self.last_row:
+            self.row_first_channel = min(self.row_first_channel, other.row_first_channel)
+            self.row_last_channel = max(self.row_last_channel, other.row_last_channel)
+        elif other.last_row > self.last_row:
+            self.last_row = other.last_row
+            self.row_first_channel, self.row_last_channel = other.row_first_channel, other.row_last_channel
+
+    def get_num_rows(self):
+        return self.last_row - self.first_row + 1
+
+    def to_dict(self):
+        """
+        :return: JSON-serializable dict of the event
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if not name.startswith('row_'))
+
+
+class EventDetector(object):
+
+    def __init__(self, num_channels, on_threshold, off_threshold=None, min_rows=1, max_gap_channels=1,
+                 max_gap_rows=0, bands=None, start_time=0.0, row_seconds=1.0, row_times=None, distances=None,
+                 callback=None):
+        """
+        :param num_channels: Channels of an SNR row
+        :param on_threshold: SNR at which a channel turns on, a number or
+                             an array of one per channel, or per band and channel
+        :param off_threshold: SNR below which a channel that is on turns
+                              off, like on_threshold, defaults to it
+        :param min_rows: Fewest rows of an event that is reported
+        :param max_gap_channels: Largest step between two channels that
+                                 are on and still part of the same event,
+                                 1 for neighbouring channels only
+        :param max_gap_rows: Rows an event may miss and still continue
+        :param bands: Label of each band of the rows, e.g. its [start end]
+                      Hz, defaults to the band index
+        :param start_time: Time of row 0, e.g. seconds since the Unix epoch
+        :param row_seconds: Time between two rows
+        :param row_times: Optional time of every row and of the end of the
+                          last one, e.g. for a last row that stacks frames
+                          of the row before, start_time and row_seconds
+                          only give the times of the rows beyond it
+        :param distances: Optional (channels,) distance of each channel,
+                          defaults to the channel index
+        :param callback: Optional function called with every Event as it
+                         completes, they aren't kept for take then
+        """
+        self.num_channels = int(num_channels)
+        self.on_threshold = numpy.asarray(on_threshold, dtype=numpy.float64)
+        self.off_threshold = self.on_threshold if off_threshold is None else \
+            numpy.asarray(off_threshold, dtype=numpy.float64)
+        if numpy.any(self.off_threshold > self.on_threshold):
+            raise Exception("EventDetector:InvalidThreshold\n"
+                            "off_threshold must not be above on_threshold")
+
+        self.min_rows = max(int(min_rows), 1)
+        self.max_gap_channels = max(int(max_gap_channels), 1)
+        self.max_gap_rows = max(int(max_gap_rows), 0)
+        self.bands = bands
+        self.start_time = start_time
+        self.row_seconds = row_seconds
+        self.row_times = None if row_times is None else numpy.asarray(row_times, dtype=numpy.float64)
+        self.distances = numpy.arange(self.num_channels, dtype=numpy.float64) if distances is None else \
+            numpy.asarray(distances, dtype=numpy.float64)
+        self.callback = callback
+
+        self.reset()
+
+    @classmethod
+    def for_analyzer(cls, analyzer, on_threshold, off_threshold=None, min_duration=0.0, all_bands=True,
+                     **options):
+        """
+        Detector of the SNR rows of an analyzer's current settings, with
+        the times of its rows (get_time_vector) and the distances of its
+        channels.  Without num_frames, e.g. when following a capture,
+        rows are row_seconds apart
+        :param analyzer: SpectralAnalysis
+        :param min_duration: Shortest event reported, in seconds
+        :param all_bands: Whether the rows hold the SNR of every band, like
+                          SpectralAnalysis.snr, or only of sf_band, like
+                          the sound field
+        :param options: Other options of EventDetector
+        :return: EventDetector
+        """
+        step = analyzer.psd_stacking_factor * int(analyzer.rolling_step)
+        row_seconds = float(step) / analyzer.prf
+
+        bands = [[float(analyzer.freq_rng[2 * i]), float(analyzer.freq_rng[2 * i + 1])]
+                 for i in range(len(analyzer.freq_rng) // 2)]
+        if not all_bands:
+            bands = [bands[analyzer.sf_band]]
+
+        options.setdefault('min_rows', int(numpy.ceil(min_duration / row_seconds)) if min_duration else 1)
+
+        row_times = None
+        if analyzer.num_frames is not None:
+            # the last row ends with the last shot of shot_rng
+            row_times = numpy.append(analyzer.get_time_vector(), analyzer.get_shot_times(analyzer.shot_rng[1] + 1))
+
+        return cls(analyzer.num_samples, on_threshold, off_threshold, bands=bands,
+                   start_time=float(analyzer.get_shot_times(analyzer.shot_rng[0])),
+                   row_seconds=row_seconds, row_times=row_times, distances=analyzer.get_dist_vector(), **options)
+
+    def reset(self):
+        self.state = None  # (bands x channels) whether each channel is on
+        self.open = []  # events still in progress
+        self.events = []  # events completed since the last take
+        self.row = 0  # index of the next row
+
+    def push(self, snr, row=None):
+        """
+        Threshold the next SNR row and update the events
+        :param snr: (bands x channels) SNR of every band, or (channels,)
+                    of a single band, e.g. SpectralAnalysis.snr
+        :param row: Index of the row, defaults to the one after the last
+        :return: list of the events this row completed
+        """
+        snr = numpy.asarray(snr)
+        if snr.ndim == 1:
+            snr = snr[numpy.newaxis]
+        row = self.row if row is None else int(row)
+        self.row = row + 1
+
+        if self.state is None:
+            self.state = numpy.zeros(snr.shape, dtype=bool)
+
+        # a channel stays on while it is above off_threshold
+        active = numpy.logical_or(snr >= self.on_threshold,
+                                  numpy.logical_and(self.state, snr >= self.off_threshold))
+        self.state = active
+
+        for band in range(snr.shape[0]):
+            channels = numpy.flatnonzero(active[band])
+            if channels.size:
+                self.add_segments(band, row, snr[band], channels)
+
+        return self.close(row)
+
+    def push_rows(self, rows, first_row=None):
+        """
+        Threshold a block of SNR rows, e.g. from SpectralAnalysis.spectrogram
+        :param rows: (rows x channels) or (rows x bands x channels) SNR
+        :param first_row: Index of the first row, defaults to the one after the last
+        :return: list of the events the rows completed
+        """
+        completed = []
+        for i in range(len(rows)):
+            completed += self.push(rows[i], None if first_row is None or i else first_row)
+
+        return completed
+
+    def add_segments(self, band, row, snr, channels):
+        """
+        Split the channels that are on into runs and add them to the events
+        they overlap, or start new events
+        :param channels: Sorted indices of the channels that are on
+        :return:
+        """
+        starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(channels) > self.max_gap_channels) + 1))
+        ends = numpy.concatenate((starts[1:], [channels.size]))
+
+        for start, end in zip(starts, ends):
+            run = channels[start:end]
+            peak = run[numpy.argmax(snr[run])]
+            first, last = int(run[0]), int(run[-1])
+
+            # events of the rows before whose newest channels this run touches
+            touching = [event for event in self.open if event.band == band and
+                        first <= event.row_last_channel + self.max_gap_channels and
+                        last >= event.row_first_channel - self.max_gap_channels]
+
+            if not touching:
+                self.open.append(Event(band, row, first, last, float(snr[peak]), int(peak)))
+                continue
+
+            event = touching[0]
+            for other in touching[1:]:
+                # the run joins events that were apart so far
+                event.merge(other)
+                self.open.remove(other)
+            event.add(row, first, last, float(snr[peak]), int(peak))
+
+    def close(self, row):
+        """
+        Complete the events that weren't continued for max_gap_rows rows
+        :param row: Index of the newest row
+        :return: list of the completed events
+        """
+        ended = [event for event in self.open if event.last_row < row - self.max_gap_rows]
+        if not ended:
+            return []
+
+        self.open = [event for event in self.open if event.last_row >= row - self.max_gap_rows]
+
+        return self.complete(ended)
+
+    def flush(self):
+        """
+        Complete every event in progress, e.g. at the end of the capture
+        :return: list of the completed events
+        """
+        ended, self.open = self.open, []
+        self.state = None
+
+        return self.complete(ended)
+
+    def complete(self, ended):
+        completed = []
+        for event in ended:
+            if event.get_num_rows() < self.min_rows:
+                continue
+
+            event.start_time = self.get_row_time(event.first_row)
+            event.end_time = self.get_row_time(event.last_row + 1)
+            event.peak_time = self.get_row_time(event.peak_row)
+            event.start_distance = float(self.distances[event.first_channel])
+            event.end_distance = float(self.distances[event.last_channel])
+            event.peak_distance = float(self.distances[event.peak_channel])
+            if self.bands is not None:
+                event.band = self.bands[event.band]
+
+            completed.append(event)
+            if self.callback is not None:
+                self.callback(event)
+
+        if self.callback is None:
+            self.events += completed
+
+        return completed
+
+    def get_row_time(self, row):
+        """
+        :param row: Sound field row
+        :return: time of the first shot of its PSD stack
+        """
+        if self.row_times is not None and row < len(self.row_times):
+            return float(self.row_times[row])
+
+        return self.start_time + row * self.row_seconds
+
+    def take(self):
+        """
+        The events completed so far, which are then cleared
+        :return: list of Event
+        """
+        events, self.events = self.events, []
+
+        return events
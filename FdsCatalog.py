@@ -0,0 +1,301 @@
+"""
+Catalog of the FDS files in a directory tree
+
+Only the headers are read, by a pool of worker processes, and what they
+hold is kept in a JSON index next to the files.  A file is only parsed
+again when its size or modification time changes, so opening the catalog
+of an archive that was scanned before costs one stat per file.  Queries
+run on numpy columns of the index:
+
+    catalog = FdsCatalog('/data/archive')
+    catalog.update()
+    for entry in catalog.query(prf=(1000, 5000), start=t0, min_duration=60):
+        reader = ReadFDS(entry['path'], None)
+        reader.read_header(catalog)
+"""
+
+import fnmatch
+import json
+import multiprocessing
+import os
+
+import numpy
+
+from FdsHeader import FdsHeader
+from ReadFDS import get_data_type
+
+
+# bump when the entries change, older indexes are then rebuilt
+INDEX_VERSION = 1
+
+
+def read_entry(path):
+    """
+    Parse the header of an FDS file into a catalog entry
+    :param path: FDS file
+    :return: (path, entry), the entry has an 'error' instead of the
+             header values when the header can't be read
+    """
+    entry = {'size': None, 'mtime': None}
+
+    try:
+        stat = os.stat(path)
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+
+        header = FdsHeader(debug=False)
+        header.process(path)
+
+        shot_bytes = get_data_type(header.data_encoding).itemsize * header.num_rows
+        values = header.values
+        prf = values.get("Acquisition.Optics.PulseRepetitionFrequency_Hz") or values.get("acquisition.laserPulseRate")
+
+        entry['header'] = header.to_dict()
+        entry['num_shots'] = max(header.file_size - header.data_start_loc, 0) // shot_bytes
+        entry['prf'] = float(prf) if prf else None
+        entry['start_time'] = header.get_start_time()
+    except Exception as e:
+        entry['error'] = str(e)
+
+    return path, entry
+
+
+class FdsCatalog(object):
+    """
+    Header index of every FDS file below a directory
+    """
+
+    INDEX_FILE = '.fds_catalog.json'
+
+    def __init__(self, root, pattern='*.fds', index_file=None, num_workers=None):
+        """
+        :param root: Directory to scan
+        :param pattern: fnmatch pattern of the file names to include
+        :param index_file: Where to keep the index, defaults to INDEX_FILE in root
+        :param num_workers: Processes parsing headers, None for the number of CPUs
+        """
+        self.root = os.path.abspath(root)
+        self.pattern = pattern
+        self.index_file = index_file or os.path.join(self.root, self.INDEX_FILE)
+        self.num_workers = num_workers
+        self.entries = {}  # entries by path relative to root
+        self.columns = None  # numpy columns for query, built on demand
+
+        self.load()
+
+    def load(self):
+        """
+        Read the saved index, an index that is missing, unreadable or
+        from another version leaves the catalog empty
+        :return:
+        """
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        if index.get('version') == INDEX_VERSION:
+            self.entries = index['files']
+            self.columns = None
+
+    def save(self):
+        """
+        Write the index, through a temporary file so a reader never sees half of it
+        :return:
+        """
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'files': self.entries}, f, separators=(',', ':'))
+        if os.name == 'nt' and os.path.exists(self.index_file):
+            os.remove(self.index_file)
+        os.rename(tmp, self.index_file)
+
+    def scan(self):
+        """
+        Find the files below root matching the pattern
+        :return: list of paths relative to root
+        """
+        paths = []
+        for directory, _, names in os.walk(self.root):
+            for name in fnmatch.filter(names, self.pattern):
+                paths.append(os.path.relpath(os.path.join(directory, name), self.root))
+
+        return sorted(paths)
+
+    def is_valid(self, name, stat=None):
+        """
+        Whether the entry of a file still matches it on disk
+        :param name: Path relative to root
+        :param stat: Optional os.stat of the file, to avoid calling it again
+        :return: bool
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+
+        if stat is None:
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                return False
+
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def update(self):
+        """
+        Bring the index up to date with the files on disk: new and changed
+        files are parsed, entries of removed files are dropped, and the
+        index is saved if anything changed
+        :return: number of files parsed
+        """
+        names = self.scan()
+
+        stale = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                # removed while scanning
+                continue
+            if not self.is_valid(name, stat):
+                stale.append(os.path.join(self.root, name))
+
+        removed = set(self.entries) - set(names)
+        for name in removed:
+            del self.entries[name]
+
+        if not stale and not removed:
+            return 0
+
+        num_workers = self.num_workers or multiprocessing.cpu_count()
+        if num_workers < 2 or len(stale) < 2:
+            results = [read_entry(path) for path in stale]
+        else:
+            pool = multiprocessing.Pool(min(num_workers, len(stale)))
+            try:
+                # headers are small, send them to the workers in batches
+                results = list(pool.imap_unordered(read_entry, stale, chunksize=16))
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        for path, entry in results:
+            self.entries[os.path.relpath(path, self.root)] = entry
+
+        self.columns = None
+        self.save()
+
+        return len(stale)
+
+    def get_entry(self, path):
+        """
+        Entry of a file, parsing its header if the index doesn't hold it or it changed
+        :param path: FDS file, absolute or relative to root
+        :return: dict with 'path' (absolute), 'size', 'mtime', 'header',
+                 'num_shots', 'prf' and 'start_time', or 'error'
+        """
+        name = os.path.relpath(os.path.join(self.root, path), self.root)
+
+        if not self.is_valid(name):
+            self.entries[name] = read_entry(os.path.join(self.root, name))[1]
+            self.columns = None
+            self.save()
+
+        return dict(self.entries[name], path=os.path.join(self.root, name))
+
+    def get_header(self, path):
+        """
+        Header of a file from the index, without reading the file unless it changed
+        :param path: FDS file, absolute or relative to root
+        :return: FdsHeader
+        """
+        entry = self.get_entry(path)
+        if 'error' in entry:
+            raise Exception("FdsCatalog:InvalidHeader\n{0}: {1}".format(entry['path'], entry['error']))
+
+        return FdsHeader.from_dict(entry['header'])
+
+    def get_columns(self):
+        """
+        The indexed values of every readable file as numpy arrays, for query
+        :return: dict of arrays, all in the order of 'name'
+        """
+        if self.columns is not None:
+            return self.columns
+
+        names = sorted(name for name, entry in self.entries.items() if 'error' not in entry)
+        entries = [self.entries[name] for name in names]
+
+        def column(values):
+            return numpy.array([numpy.nan if value is None else value for value in values], dtype=float)
+
+        prf = column(entry['prf'] for entry in entries)
+        num_shots = numpy.array([entry['num_shots'] for entry in entries], dtype=numpy.int64)
+
+        self.columns = {
+            'name': names,
+            'prf': prf,
+            'num_channels': numpy.array([entry['header']['num_rows'] for entry in entries], dtype=numpy.int64),
+            'encoding': numpy.array([entry['header']['data_encoding'].strip().lower() for entry in entries],
+                                    dtype=object),
+            'num_shots': num_shots,
+            'start_time': column(entry['start_time'] for entry in entries),
+            'duration': num_shots / prf,
+        }
+
+        return self.columns
+
+    def query(self, prf=None, num_channels=None, start=None, end=None, min_duration=None, max_duration=None,
+              encoding=None):
+        """
+        Files matching every given condition, conditions left at None
+        are ignored.  prf and num_channels take a value or an inclusive
+        (min, max) range where either end may be None
+        :param prf: Pulse rate in Hz
+        :param num_channels: Samples per shot
+        :param start: Only files still recording at or after this time,
+                      seconds since the Unix epoch
+        :param end: Only files that started at or before this time
+        :param min_duration: Shortest recording in seconds
+        :param max_duration: Longest recording in seconds
+        :param encoding: DataEncoding of the samples
+        :return: list of entries as get_entry returns them, by start time
+        """
+        columns = self.get_columns()
+        start_time = columns['start_time']
+        duration = columns['duration']
+        mask = numpy.ones(len(columns['name']), dtype=bool)
+
+        def in_range(values, rng):
+            if not isinstance(rng, (tuple, list)):
+                rng = (rng, rng)
+            if rng[0] is not None:
+                mask[...] &= values >= rng[0]
+            if rng[1] is not None:
+                mask[...] &= values <= rng[1]
+
+        # comparisons with NaN are False, files without the value never match
+        with numpy.errstate(invalid='ignore'):
+            if prf is not None:
+                in_range(columns['prf'], prf)
+            if num_channels is not None:
+                in_range(columns['num_channels'], num_channels)
+            if start is not None:
+                mask &= start_time + duration >= start
+            if end is not None:
+                mask &= start_time <= end
+            in_range(duration, (min_duration, max_duration))
+            if encoding is not None:
+                mask &= columns['encoding'] == encoding.strip().lower()
+
+        # files without a start time last
+        order = numpy.flatnonzero(mask)
+        times = start_time[order]
+        order = order[numpy.argsort(numpy.where(numpy.isnan(times), numpy.inf, times), kind='mergesort')]
+
+        return [dict(self.entries[columns['name'][i]], path=os.path.join(self.root, columns['name'][i]))
+                for i in order]
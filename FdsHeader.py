@@ -9,11 +9,31 @@ __author__ = 'o1806'
     section of the FDS file.
 """
 
+import calendar
+import re
 import sys
 import os
 import numpy as np
 
 
+def parse_timestamp(string):
+    """
+    Convert an FDS timestamp such as '2014-07-08T17:29:59.0000000Z' to
+    seconds since the Unix epoch.  Times without a zone are taken as UTC
+    :param string: 'yyyy-mm-ddTHH:MM:SS[.FFFFFFF][Z]', the date may also
+                   be separated by ':' or '.'
+    :return: float seconds, None if the string isn't a timestamp
+    """
+    m = re.match(r'\s*(\d{4})[-:.](\d{2})[-:.](\d{2})[T .](\d{2})[:.](\d{2})[:.](\d{2})(\.\d+)?', string or '')
+    if m is None:
+        return None
+
+    fields = [int(value) for value in m.groups()[:6]]
+    seconds = calendar.timegm(fields + [0, 0, 0])
+
+    return seconds + float(m.group(7) or 0)
+
+
 class FdsHeader(object):
 
     DEBUG = None
@@ -36,9 +56,53 @@ class FdsHeader(object):
 
         self.file_size = None
 
+    # attributes saved by to_dict, enough to read the data without the header
+    CACHED = ['fds_version', 'data_start_loc', 'header_section_sizes_bytes', 'header_section_labels',
+              'num_rows', 'data_encoding', 'num_ascii_blocks', 'values', 'file_size']
+
+    def to_dict(self):
+        """
+        The parsed header as plain values, e.g. to save in a JSON index
+        :return: dict
+        """
+        state = dict((name, getattr(self, name)) for name in self.CACHED)
+        state['header_section_sizes_bytes'] = [int(size) for size in self.header_section_sizes_bytes or []]
+
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Header from the values of to_dict, without reading the file
+        :param state: dict from to_dict
+        :return: FdsHeader
+        """
+        header = cls()
+        for name in cls.CACHED:
+            setattr(header, name, state.get(name))
+        if header.num_ascii_blocks is not None:
+            header.header_section_ends = np.cumsum(header.header_section_sizes_bytes)
+
+        return header
+
+    def get_start_time(self):
+        """
+        Time of the first shot
+        :return: float seconds since the Unix epoch, None if not in the header
+        """
+        return parse_timestamp(self.values.get("TimeOfFirstSample"))
+
     @staticmethod
-    def get_header_value(string):
-        values = string.split('=')
+    def to_text(line):
+        """
+        A line of the file as str, the file is read as bytes, which are
+        already str on Python 2
+        """
+        return line if isinstance(line, str) else line.decode('latin-1')
+
+    @classmethod
+    def get_header_value(cls, string):
+        values = cls.to_text(string).split('=')
         return values[1].strip()
 
     @staticmethod
@@ -75,7 +139,7 @@ class FdsHeader(object):
             line = self.strip_line(line)
             self.header_section_sizes_bytes = line.split()
             # convert the string values to ints
-            self.header_section_sizes_bytes = map(int, self.header_section_sizes_bytes)
+            self.header_section_sizes_bytes = list(map(int, self.header_section_sizes_bytes))
             if self.DEBUG:
                 print("header_section_bytes: ")
                 print(self.header_section_sizes_bytes)
@@ -124,7 +188,17 @@ class FdsHeader(object):
             # parse tags and values
             # reset the file position to zero to read all values
             infile.seek(0)
-            header_section = infile.readlines(self.header_section_sizes_bytes[-1])
+            # lines up to the first one past the header size, which is
+            # dropped, like readlines(size) on Python 3.  Python 2 rounds
+            # the hint up and reads lines of the data
+            header_section = []
+            num_bytes = 0
+            while num_bytes <= self.header_section_sizes_bytes[-1]:
+                line = infile.readline()
+                if not line:
+                    break
+                header_section.append(self.to_text(line))
+                num_bytes += len(line)
             del header_section[-1]
             if self.DEBUG:
                 print("header_section: ")
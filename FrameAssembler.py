@@ -0,0 +1,79 @@
+"""
+Assemble overlapping FFT frames from a stream of shots
+"""
+
+import numpy
+
+
+class FrameAssembler(object):
+    """
+    Collect shots in a preallocated circular buffer and hand out a frame
+    of num_fft shots every rolling_step shots.
+
+    Every shot is written twice, at i % num_fft and at i % num_fft +
+    num_fft, so the last num_fft shots are always a contiguous slice of
+    the buffer.  A hop costs two copies of the new shots no matter how
+    long the capture is, instead of rolling the whole frame.
+    """
+
+    def __init__(self, num_fft, rolling_step, num_channels, dtype=numpy.float64):
+        self.num_fft = int(num_fft)
+        self.rolling_step = int(rolling_step)
+
+        if not 0 < self.rolling_step <= self.num_fft:
+            raise Exception("FrameAssembler:InvalidStep\n"
+                            "rolling_step must be between 1 and num_fft")
+
+        self.buffer = numpy.zeros((2 * self.num_fft, num_channels), dtype=dtype)
+        self.num_shots = 0  # shots pushed so far
+        self.num_frames = 0  # frames handed out so far
+
+    def reset(self):
+        self.num_shots = 0
+        self.num_frames = 0
+
+    def get_next_frame_end(self):
+        """
+        Number of shots pushed when the next frame is complete
+        :return: int
+        """
+        return self.num_fft + self.num_frames * self.rolling_step
+
+    def write(self, shots):
+        """
+        Copy shots into the buffer, at most num_fft of them
+        :param shots: (shots x channels) array
+        :return:
+        """
+        count = shots.shape[0]
+        start = self.num_shots % self.num_fft
+        first = min(count, self.num_fft - start)
+
+        # the first part up to the end of the ring, the rest wraps around
+        for begin, end, offset in [(start, start + first, 0), (0, count - first, first)]:
+            if end > begin:
+                self.buffer[begin:end] = shots[offset:offset + end - begin]
+                self.buffer[begin + self.num_fft:end + self.num_fft] = shots[offset:offset + end - begin]
+
+        self.num_shots += count
+
+    def push(self, shots):
+        """
+        Add shots and yield every frame they complete.  A frame is a view
+        of the buffer and is only valid until the generator continues
+        :param shots: (shots x channels) array of any length
+        :return: generator of (num_fft x channels) frames
+        """
+        offset = 0
+
+        while offset < shots.shape[0]:
+            # write up to the end of the next frame, but never more
+            # than the ring holds
+            count = min(shots.shape[0] - offset, self.get_next_frame_end() - self.num_shots, self.num_fft)
+            self.write(shots[offset:offset + count])
+            offset += count
+
+            if self.num_shots == self.get_next_frame_end():
+                self.num_frames += 1
+                start = self.num_shots % self.num_fft
+                yield self.buffer[start:start + self.num_fft]
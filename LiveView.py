@@ -0,0 +1,155 @@
+"""
+Live view of the sound field while it is computed
+
+The analysis runs in a worker thread and hands its newest rows to the
+plot through a LatestValue, which only ever holds the last thing put in
+it.  The plot runs in the main thread, like matplotlib wants, with a
+FuncAnimation as in ImageAnimation.py: one image artist is updated with
+set_data and blitted at most max_fps times a second, however fast rows
+arrive, so drawing takes only a small share of the time.
+"""
+
+import sys
+import threading
+
+import numpy
+
+
+class LatestValue(object):
+    """
+    A queue of length one where a new item replaces the one waiting.  The
+    producer never blocks and the consumer only sees the newest item
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.item = None
+        self.fresh = False  # whether item wasn't taken yet
+
+    def put(self, item):
+        with self.lock:
+            self.item = item
+            self.fresh = True
+
+    def take(self):
+        """
+        :return: the newest item if it wasn't taken before, else None
+        """
+        with self.lock:
+            if not self.fresh:
+                return None
+            self.fresh = False
+            return self.item
+
+
+class LiveView(object):
+
+    def __init__(self, num_channels, num_rows=512, max_fps=10, max_width=1024, title='Sound field'):
+        """
+        :param num_channels: Channels of a sound field row
+        :param num_rows: Newest rows shown, newest on top
+        :param max_fps: Most redraws per second
+        :param max_width: Most columns drawn, channels are combined by
+                          their max beyond that
+        :param title: Title of the figure
+        """
+        self.num_channels = int(num_channels)
+        self.num_rows = int(num_rows)
+        self.max_fps = max_fps
+        self.title = title
+        self.latest = LatestValue()
+
+        # groups of channels drawn as one column
+        group = -(-self.num_channels // max(int(max_width), 1))
+        self.column_starts = numpy.arange(0, self.num_channels, group)
+
+        self.frame = numpy.full((self.num_rows, len(self.column_starts)), numpy.nan)
+        self.figure = None
+        self.image = None
+        self.animation = None
+
+    def put(self, rows):
+        """
+        Offer the newest rows to the plot, cheap enough to call for every row
+        :param rows: (rows x channels) array, newest first, or a function
+                     returning it when the rows are drawn, e.g.
+                     ResultWindow.newest_first, whose view is only valid
+                     until the next row is appended
+        :return:
+        """
+        self.latest.put(rows)
+
+    def update(self, *args):
+        """
+        Copy the newest rows into the image, called by the animation
+        :return: tuple of the artists to blit
+        """
+        rows = self.latest.take()
+        if rows is None:
+            return self.image,
+
+        if callable(rows):
+            rows = rows()
+        rows = numpy.asarray(rows[:self.num_rows])
+        count = rows.shape[0]
+        if count:
+            if len(self.column_starts) < self.num_channels:
+                rows = numpy.maximum.reduceat(rows, self.column_starts, axis=1)
+            self.frame[:count] = rows
+            self.frame[count:] = numpy.nan
+
+            # the colors follow the range of the rows in view
+            low, high = numpy.nanmin(self.frame), numpy.nanmax(self.frame)
+            if high > low:
+                self.image.set_clim(low, high)
+
+        self.image.set_data(self.frame)
+
+        return self.image,
+
+    def run(self, compute):
+        """
+        Run compute in a worker thread while the plot is shown, the
+        window stays open when it is done until it is closed
+        :param compute: Function doing the analysis, calling put with new rows
+        :return:
+        """
+        # only needed with a display, so not imported before
+        from matplotlib import animation
+        from matplotlib import pyplot as plt
+
+        error = []
+
+        def work():
+            try:
+                compute()
+            except Exception:
+                error.append(sys.exc_info())
+
+        self.figure = plt.figure()
+        self.figure.suptitle(self.title)
+        self.image = plt.imshow(self.frame, aspect='auto', animated=True,
+                                extent=(0, self.num_channels, self.num_rows, 0))
+
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        # before the animation, which may draw its first frame right away
+        thread.start()
+
+        def update(*args):
+            done = not thread.is_alive()
+            artists = self.update()
+            # the animation draws its first frame before it is assigned,
+            # it is stopped by the next call then
+            if done and self.animation is not None:
+                # the last rows are drawn, nothing changes after them
+                self.animation.event_source.stop()
+            return artists
+
+        self.animation = animation.FuncAnimation(self.figure, update, interval=1000.0 / self.max_fps,
+                                                 blit=True)
+        plt.show()
+        thread.join()
+
+        if error:
+            raise error[0][1]
@@ -0,0 +1,91 @@
+"""
+Noise floor estimators used by SpectralAnalysis
+"""
+
+import numpy
+
+
+def partition_median(region):
+    """
+    Exact median over the bins axis using a partial sort.  The bins are
+    first copied so they are contiguous for every channel, which makes
+    the partition much cheaper than working along the strided axis
+    :param region: (..., bins, channels) PSD rows
+    :return: (..., channels) median, same values as numpy.median
+    """
+    num_bins = region.shape[-2]
+    work = numpy.swapaxes(region, -1, -2).copy()
+    k = num_bins // 2
+
+    if num_bins % 2:
+        work.partition(k, axis=-1)
+        return work[..., k]
+
+    work.partition([k - 1, k], axis=-1)
+    return (work[..., k - 1] + work[..., k]) / 2
+
+
+class NoiseFloorEstimator(object):
+    """
+    Estimate the noise floor of every channel from the noise region of
+    the PSD.
+
+    'median'     exact median with numpy.median
+    'partition'  exact median with a partial sort, see partition_median
+    'smoothed'   exponentially smoothed running median.  Every frame only
+                 takes the median of one in `subsample` bins, rotating
+                 through them, and moves the estimate by `smoothing`
+                 towards it.  The estimate depends on the frames before,
+                 so frames must be passed in order and can't be split
+                 over processes
+    """
+
+    METHODS = ['median', 'partition', 'smoothed']
+
+    def __init__(self, method='median', smoothing=0.1, subsample=8):
+        if method not in self.METHODS:
+            raise Exception("NoiseFloorEstimator:UnknownMethod\n"
+                            "Unknown noise floor method '{0}', use one of {1}".format(method, self.METHODS))
+
+        self.method = method
+        self.smoothing = smoothing
+        self.subsample = int(subsample)
+
+        self.noise_floor = None  # running estimate of 'smoothed'
+        self.count = 0  # frames seen since the last reset
+
+    @property
+    def stateful(self):
+        return self.method == 'smoothed'
+
+    def reset(self):
+        self.noise_floor = None
+        self.count = 0
+
+    def estimate(self, region):
+        """
+        Noise floor of one or more frames
+        :param region: (..., bins, channels) noise region of the PSD
+        :return: (..., channels) noise floor
+        """
+        if self.method == 'median':
+            return numpy.median(region, axis=-2)
+        elif self.method == 'partition':
+            return partition_median(region)
+
+        frames = region.reshape((-1,) + region.shape[-2:])
+        noise_floor = numpy.empty((frames.shape[0], frames.shape[2]), dtype=region.dtype)
+
+        for i in range(frames.shape[0]):
+            if self.noise_floor is None:
+                # start from the exact value
+                self.noise_floor = partition_median(frames[i])
+            else:
+                offset = self.count % self.subsample
+                sample = partition_median(frames[i, offset::self.subsample])
+                self.noise_floor += self.smoothing * (sample - self.noise_floor)
+
+            self.count += 1
+            noise_floor[i] = self.noise_floor
+
+        return noise_floor.reshape(region.shape[:-2] + region.shape[-1:])
@@ -0,0 +1,141 @@
+"""
+Multi-process ('N-CPU') backend for SpectralAnalysis
+
+The sound field rows of the shot range are split into contiguous
+shards of whole PSD stacks.  Every shard is read with num_fft -
+rolling_step shots of overlap with its neighbour so that each worker
+can build all of its frames on its own, and the rows are written
+straight into a result matrix shared by all workers, or into the files
+of a ResultStore.  Each frame goes through the same code as the serial path,
+so the result is identical to SpectralAnalysis.spectrogram.
+"""
+
+import multiprocessing
+
+import numpy
+
+
+# state of a worker process, set once by init_worker
+_worker = {}
+
+
+def init_worker(analyzer, num_frames, shared, shape, psd_file=None):
+    """
+    :param shared: RawArray of the result, or the path of a .npy file
+    :param psd_file: Optional path of a .npy file for the PSD
+    """
+    # the workers already use every CPU, don't split channels over threads too
+    analyzer.num_threads = 1
+    _worker['analyzer'] = analyzer
+    _worker['num_frames'] = num_frames
+    _worker['data'] = analyzer.get_roi_data()
+    if isinstance(shared, str):
+        _worker['sf'] = numpy.load(shared, mmap_mode='r+')
+    else:
+        _worker['sf'] = numpy.frombuffer(shared, dtype=analyzer.get_dtype()).reshape(shape)
+    _worker['psd'] = None if psd_file is None else numpy.load(psd_file, mmap_mode='r+')
+
+
+def process_shard(row_rng):
+    """
+    Compute the sound field rows [first, last) in a worker
+    :param row_rng: (first, last) row indices relative to the ROI
+    :return: (number of rows processed, the worker's stage times since
+             its last shard, see Profiler.take)
+    """
+    first, last = row_rng
+    analyzer = _worker['analyzer']
+    psd = _worker['psd']
+
+    start, stop = analyzer.get_row_shots(first, last, _worker['num_frames'])
+
+    analyzer.spectrogram(_worker['data'][start:stop], out=_worker['sf'][first:last],
+                         psd_out=None if psd is None else psd[first:last])
+
+    # rows written to a file must be on disk before they are checkpointed
+    for result in (_worker['sf'], psd):
+        if isinstance(result, numpy.memmap):
+            result.flush()
+
+    return last - first, analyzer.profiler.take()
+
+
+def get_shards(num_items, num_shards):
+    """
+    Split a number of rows, channels etc. into contiguous, nearly equal ranges
+    :param num_items: Total number of items
+    :param num_shards: Number of ranges wanted
+    :return: list of (first, last) indices
+    """
+    num_shards = max(min(num_shards, num_items), 1)
+    bounds = numpy.linspace(0, num_items, num_shards + 1).astype(int)
+
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(num_shards) if bounds[i] < bounds[i + 1]]
+
+
+def spectrogram(analyzer, num_workers=None, store=None):
+    """
+    Compute the sound field of the analyzer's ROI in worker processes
+    :param analyzer: SpectralAnalysis instance
+    :param num_workers: Number of processes, defaults to the number of CPUs
+    :param store: Optional ResultStore the workers write to, only the
+                  rows it doesn't hold yet are computed
+    :return: (rows x channels) SNR, same as analyzer.spectrogram
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+
+    data = analyzer.get_roi_data()
+    num_frames = analyzer.get_num_frames(data.shape[0])
+    num_rows = analyzer.get_num_rows(num_frames)
+    shape = (num_rows, analyzer.binner.get_num_bins(data.shape[1]))
+    first_row = 0 if store is None else store.count
+
+    # a running noise floor estimate needs every frame before it
+    if num_workers < 2 or num_rows - first_row < 2 or analyzer.nf_estimator.stateful:
+        if store is not None:
+            processor, analyzer.processor = analyzer.processor, 'CPU'
+            try:
+                return analyzer.compute_sound_field(store)
+            finally:
+                analyzer.processor = processor
+        return analyzer.spectrogram(data)
+
+    # a few shards per worker keeps them all busy until the end, with a
+    # store they are also small enough to checkpoint every few rows
+    num_shards = num_workers * 4
+    if store is not None:
+        num_shards = max(num_shards, (num_rows - first_row) // store.checkpoint_rows)
+    shards = [(first_row + first, first_row + last) for first, last in get_shards(num_rows - first_row, num_shards)]
+
+    if store is None:
+        shared = multiprocessing.RawArray('f' if analyzer.precision == 'single' else 'd', num_rows * shape[1])
+        args = (analyzer, num_frames, shared, shape)
+    else:
+        # the rows written so far must be on disk before the workers open the files
+        store.checkpoint()
+        args = (analyzer, num_frames, store.get_file(store.SF_FILE), shape,
+                None if store.psd is None else store.get_file(store.PSD_FILE))
+    pool = multiprocessing.Pool(min(num_workers, len(shards)), init_worker, args)
+
+    try:
+        # in order, so every finished shard completes the rows before it
+        for (first, last), (_, stages) in zip(shards, pool.imap(process_shard, shards)):
+            analyzer.profiler.merge(stages)
+            if store is not None:
+                with analyzer.profiler.stage('sink'):
+                    store.checkpoint(last)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    if store is None:
+        analyzer.sf = numpy.frombuffer(shared, dtype=analyzer.get_dtype()).reshape(shape)
+    else:
+        analyzer.sf = store.data
+    if num_rows:
+        analyzer.snr = analyzer.sf[-1]
+
+    return analyzer.sf
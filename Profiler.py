@@ -0,0 +1,257 @@
+"""
+Timers and throughput counters for the stages of the analysis
+"""
+
+import json
+import threading
+import time
+from timeit import default_timer
+
+
+class _Stage(object):
+    """
+    Context manager adding the time spent in its block to a stage
+    """
+
+    __slots__ = ('profiler', 'name', 'counts', 'start')
+
+    def __init__(self, profiler, name, counts):
+        self.profiler = profiler
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, default_timer() - self.start, **self.counts)
+
+
+class _NoStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+class Profiler(object):
+    """
+    Cumulative time, calls, bytes, shots and frames per stage of the
+    pipeline, e.g. 'header', 'read', 'decode', 'assemble', 'fft',
+    'stack', 'noise_floor', 'snr' and 'sink', and the peak memory of the
+    buffers in use.  Stages of parallel threads add up, so their sum can
+    be more than the wall time.  A disabled profiler costs one attribute
+    check per stage.
+
+        profiler = Profiler(callback=print_progress)
+        with profiler.stage('decode', shots=n, bytes=raw.nbytes):
+            ...
+        profiler.write_json('profile.json')
+    """
+
+    COUNTERS = ('bytes', 'shots', 'frames')
+
+    def __init__(self, enabled=True, callback=None, interval=1.0):
+        """
+        :param enabled: Whether anything is recorded
+        :param callback: Optional function called with report() at most
+                         every interval seconds while stages are added,
+                         and by finish()
+        :param interval: Seconds between two calls of the callback
+        """
+        self.enabled = enabled
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        # copies in worker processes start empty and without the callback,
+        # their stages come back through take() and merge()
+        state = self.__dict__.copy()
+        del state['lock']
+        state['callback'] = None
+        state['stages'] = {}
+        state['buffers'] = {}
+        state['peak_buffer_bytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.stages = {}
+        self.buffers = {}  # bytes of each buffer in use
+        self.peak_buffer_bytes = 0
+        self.start_time = default_timer()
+        self.last_callback = self.start_time
+
+    def stage(self, name, **counts):
+        """
+        Time a block of code as part of a stage
+        :param name: Stage name
+        :param counts: bytes, shots and frames the block processes
+        :return: context manager
+        """
+        if not self.enabled:
+            return _NO_STAGE
+
+        return _Stage(self, name, counts)
+
+    def add(self, name, seconds, calls=1, **counts):
+        """
+        Add time and counts to a stage
+        :param name: Stage name
+        :param seconds: Time spent
+        :param calls: Number of calls the time covers
+        :param counts: bytes, shots and frames processed
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = dict({'seconds': 0.0, 'calls': 0}, **dict.fromkeys(self.COUNTERS, 0))
+            stage['seconds'] += seconds
+            stage['calls'] += calls
+            for key, value in counts.items():
+                stage[key] += value
+
+        if self.callback is not None and default_timer() - self.last_callback >= self.interval:
+            self.last_callback = default_timer()
+            self.callback(self.report())
+
+    def set_buffer(self, name, nbytes):
+        """
+        Record the size of a buffer in use, 0 once it is released
+        :param name: Buffer name
+        :param nbytes: Its size in bytes
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.buffers[name] = int(nbytes)
+            self.peak_buffer_bytes = max(self.peak_buffer_bytes, sum(self.buffers.values()))
+
+    def take(self):
+        """
+        The stages recorded so far, which are then cleared, e.g. to send
+        them from a worker process to merge
+        :return: dict
+        """
+        with self.lock:
+            taken = {'stages': self.stages, 'peak_buffer_bytes': self.peak_buffer_bytes}
+            self.stages = {}
+            self.peak_buffer_bytes = sum(self.buffers.values())
+
+        return taken
+
+    def merge(self, taken):
+        """
+        Add the stages of another profiler, from its take().  Its peak
+        buffer memory counts on top of the buffers in use here, workers
+        running side by side aren't added up
+        :param taken: dict from take()
+        :return:
+        """
+        if not self.enabled or not taken:
+            return
+
+        for name, stage in taken['stages'].items():
+            self.add(name, stage['seconds'], stage['calls'],
+                     **dict((key, stage[key]) for key in self.COUNTERS))
+
+        with self.lock:
+            self.peak_buffer_bytes = max(self.peak_buffer_bytes,
+                                         sum(self.buffers.values()) + taken['peak_buffer_bytes'])
+
+    def report(self):
+        """
+        :return: dict with the wall time, the peak buffer memory, the
+                 overall bytes, shots (of 'decode') and frames (of 'fft')
+                 per second of wall time, and per stage the seconds,
+                 calls, counts and rates per second of the stage
+        """
+        wall = default_timer() - self.start_time
+
+        with self.lock:
+            stages = dict((name, dict(stage)) for name, stage in self.stages.items())
+            peak = self.peak_buffer_bytes
+
+        for stage in stages.values():
+            for key in self.COUNTERS:
+                if stage[key]:
+                    stage[key + '_per_s'] = stage[key] / stage['seconds'] if stage['seconds'] else None
+
+        decode = stages.get('decode', {})
+        frames = stages.get('fft', {}).get('frames', 0)
+
+        return {
+            'time': time.time(),
+            'wall_seconds': wall,
+            'bytes_per_s': decode.get('bytes', 0) / wall if wall else None,
+            'shots_per_s': decode.get('shots', 0) / wall if wall else None,
+            'frames_per_s': frames / wall if wall else None,
+            'stage_seconds': sum(stage['seconds'] for stage in stages.values()),
+            'peak_buffer_bytes': peak,
+            'stages': stages,
+        }
+
+    def finish(self):
+        """
+        Call the callback with the final report
+        :return: report()
+        """
+        report = self.report()
+        if self.callback is not None:
+            self.callback(report)
+
+        return report
+
+    def write_json(self, path, extra=None):
+        """
+        Save report() as JSON, e.g. to compare releases
+        :param path: File to write
+        :param extra: Optional dict added to the report, e.g. the file and settings
+        :return: the report
+        """
+        report = self.report()
+        if extra:
+            report.update(extra)
+
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+
+        return report
+
+    def format(self):
+        """
+        :return: report() as a table of the stages, slowest first
+        """
+        report = self.report()
+        lines = ['{0:<12} {1:>10} {2:>7} {3:>10} {4:>14} {5:>12}'.format(
+            'stage', 'seconds', 'share', 'calls', 'MB/s', 'frames/s')]
+
+        for name, stage in sorted(report['stages'].items(), key=lambda item: -item[1]['seconds']):
+            share = stage['seconds'] / report['wall_seconds'] if report['wall_seconds'] else 0
+            lines.append('{0:<12} {1:>10.3f} {2:>6.1%} {3:>10} {4:>14} {5:>12}'.format(
+                name, stage['seconds'], share, stage['calls'],
+                '{0:.1f}'.format(stage['bytes_per_s'] / 1e6) if stage.get('bytes_per_s') else '',
+                '{0:.0f}'.format(stage['frames_per_s']) if stage.get('frames_per_s') else ''))
+
+        lines.append('wall {0:.3f} s, {1:.1f} MB/s, {2:.0f} shots/s, {3:.0f} frames/s, peak buffers {4:.1f} MB'.format(
+            report['wall_seconds'], (report['bytes_per_s'] or 0) / 1e6, report['shots_per_s'] or 0,
+            report['frames_per_s'] or 0, report['peak_buffer_bytes'] / 1e6))
+
+        return '\n'.join(lines)
@@ -2,15 +2,25 @@ __author__ = 'o1806'
 
 
 # local imports
+from EventDetector import EventDetector
+from FrameAssembler import FrameAssembler
+from LiveView import LiveView
+from Profiler import Profiler
 from ReadFDS import ReadFDS
+from ResultCache import ResultCache
+from ResultSink import ResultSink, ResultStore, ResultWindow
 from SpectralAnalysis import SpectralAnalysis
-from SpectralAnalysisApp import SpectralAnalysisApp
-from SpectralAnalysisApp import get_file_path
+from SoundFieldPyramid import SoundFieldPyramid
 
 # module imports
+import json
+import sys
 import time
+from timeit import default_timer
 import numpy as np
-from matplotlib import pyplot as plt
+
+# Tkinter and matplotlib are only imported when a dialog or a plot is
+# shown, see Batch.py for analyzing files without a display
 
 
 class bcolors:
@@ -27,7 +37,78 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-def main():
+def read_frames(reader, analyzer, first_frame=0, follow=False, timeout=None):
+    """
+    Read the shots of the analyzer's ROI in chunks of one rolling step
+    and yield (iteration, frame) pairs once a full frame is available.
+    Whole shots are read, only the ROI channels are decoded and binned
+    into the frames
+    :param reader: ReadFDS with the header already read
+    :param analyzer: SpectralAnalysis giving num_fft, rolling_step and the ROI
+    :param first_frame: Number of frames of the ROI to skip, to resume a run
+    :param follow: Keep reading as the file grows while it is acquired,
+                   a frame is yielded as soon as its last shot is written
+    :param timeout: Seconds without new shots that end following, None to follow until stopped
+    :return: generator of (iteration, frame), the frame is only
+             valid until the generator continues
+    """
+    channels = analyzer.get_channel_slice()
+    rolling_step = int(analyzer.rolling_step)
+    profiler = analyzer.profiler
+
+    assembler = FrameAssembler(analyzer.num_fft, rolling_step, analyzer.num_samples,
+                               dtype=analyzer.decoder.dtype)
+    bytes_to_read = rolling_step * reader.get_shot_bytes()
+    volts = np.empty((rolling_step, channels.stop - channels.start), dtype=analyzer.decoder.dtype)
+    binned = np.empty((rolling_step, analyzer.num_samples), dtype=analyzer.decoder.dtype)
+    profiler.set_buffer('assemble', assembler.buffer.nbytes + volts.nbytes + binned.nbytes)
+
+    # it takes 2 iterations to have a set because the
+    # rolling step is half the size of an FFT process
+    iteration = 1 + first_frame
+
+    first_shot = analyzer.shot_rng[0] + first_frame * rolling_step
+    if follow:
+        # whole rolling steps as soon as they are written, until stopped
+        chunks = reader.follow_chunks(reader.get_shot_offset(first_shot), bytes_to_read, timeout=timeout)
+    else:
+        # the next chunks are read in the background while this one is analyzed
+        chunks = reader.prefetch_chunks(reader.get_shot_offset(first_shot), bytes_to_read,
+                                        stop=reader.get_shot_offset(analyzer.shot_rng[1] + 1))
+
+    for chunk in chunks:
+        # whole shots of the uint8 chunk
+        array = chunk[:chunk.size - chunk.size % reader.get_shot_bytes()].view(reader.get_data_type())
+        array = (np.reshape(array, (-1, reader.header.num_rows)))
+
+        # only the ROI channels are decoded, into the same buffer every time
+        with profiler.stage('decode', shots=array.shape[0], bytes=len(chunk)):
+            array = analyzer.decoder.decode(array[:, channels], out=volts[:array.shape[0]])
+
+        # neighbouring channels are reduced before the frames are assembled
+        if analyzer.binner.enabled:
+            with profiler.stage('bin', shots=array.shape[0]):
+                array = analyzer.binner.bin(array, out=binned[:array.shape[0]])
+
+        # the time of the caller between two frames isn't counted
+        frames = assembler.push(array)
+        while True:
+            start = default_timer()
+            mat = next(frames, None)
+            profiler.add('assemble', default_timer() - start)
+            if mat is None:
+                break
+
+            iteration += 1
+            yield iteration, mat
+
+
+def main(file_in=None):
+    """
+    Analyze a file and plot its sound field
+    :param file_in: FDS file, asked for with a file dialog when None
+    :return:
+    """
 
     #app = SpectralAnalysisApp(None)
     #app.title('Spectral Analysis')
@@ -36,9 +117,26 @@ def main():
     #exit()
 
     animate = False
+    use_mmap = True
+    follow = False  # analyze the file while it is still being acquired
+    window_rows = 2000  # sound field rows kept in memory when following
+    follow_timeout = 10  # seconds without new shots that end the capture
+    time_window = None  # e.g. ('14:02:10', '14:05:00') to analyze only the shots recorded then
+    channel_binning = None  # e.g. (4, 4, 'mean') to average groups of 4 neighbouring channels before the FFT
+    use_cache = False  # reuse the sound field of an earlier run, kept up to 4 GB in ~/.spectral_analysis
+    save_results = False  # keep the rows in <input>_processed, where a run that was killed resumes
+    view_shape = (1024, 1024)  # most rows and channels drawn, larger results are shown downsampled
+    max_fps = 10  # most redraws per second of the animation
+    profile = False  # time every stage, the report is saved next to the input, which must be writable
+    event_threshold = None  # SNR at which an event starts, None to not detect events
+    event_hysteresis = 0.75  # an event goes on until the SNR falls below this share of event_threshold
+    event_min_duration = 0.5  # seconds, shorter events are dropped
+    events_only = False  # only detect events, the sound field is neither kept nor plotted
 
     # get the file to open
-    file_in = get_file_path()
+    if file_in is None:
+        from SpectralAnalysisApp import get_file_path
+        file_in = get_file_path()
     file_out = file_in + '_original.txt'
     #file_processed = '../' + file_main + '_processed.txt'
 
@@ -47,82 +145,201 @@ def main():
     # set console color to green
     print(bcolors.OKGREEN)
 
-    # define the file reader
+    # define the file reader, the analyzer shares its profiler
     reader = ReadFDS(file_in, file_out)
+    reader.profiler = Profiler(enabled=profile)
     reader.read_header()
 
     # define the analyzer
     analyzer = SpectralAnalysis(reader)
+    if time_window is not None:
+        analyzer.set_time_rng(*time_window)
+    if channel_binning is not None:
+        analyzer.set_binning(*channel_binning)
 
     # initializers
     num_frames = analyzer.num_frames
     num_fft = analyzer.num_fft
-    num_fft_half = num_fft / 2
-    processed = np.zeros((num_frames, reader.header.num_rows))
-    mat = np.zeros((num_fft, reader.header.num_rows))
-
-    # TODO: Calculate bytes_to_read dynamically
-    # TODO: i.e. frame_size * data_type_size
-    bytes_to_read = num_fft * reader.header.num_rows
-    iteration = 0
-
-    if animate:
-        plt.figure()
-        plt.imshow(processed, aspect='auto')
-
-    for chunk in reader.read_chunks(reader.header.data_start_loc, bytes_to_read):
-        print("{0} of {1}".format(iteration, num_frames + 1))
-
-        array = np.fromstring(chunk, dtype=np.uint16)
-
-        # convert bad values to zero, this is done in MATLAB as well
-        array = np.nan_to_num(array)
-        array = (np.reshape(array, (-1, reader.header.num_rows)))
-
-        # roll the values down the matrix to be replaced by
-        # the next rolling step
-        mat = np.roll(mat, num_fft_half, axis=0)
-
-        if array.shape[0] != num_fft_half:
-            break
-            mat[num_fft_half:] = 0
-            print("shape {0}".format(array.shape))
-            mat[num_fft_half:num_fft_half + array.shape[0]] = array
+    num_rows = analyzer.get_num_rows(num_frames)
+    pyramid = None
+
+    # with save_results the rows are saved next to the input and a run
+    # that was killed continues after the last row it saved
+    analyzer.output_path = file_in + '_processed'
+    sink = None
+    cached = None  # sound field of an earlier run, found in the cache
+    if follow:
+        # the length is unknown, only the newest rows are kept
+        # and the last row ends wherever the capture stops
+        analyzer.num_frames = None
+        sink = ResultWindow(window_rows, analyzer.num_samples, dtype=analyzer.get_dtype())
+    elif events_only:
+        if event_threshold is None:
+            raise Exception("Program:InvalidSettings\nevents_only needs an event_threshold")
+    elif use_cache:
+        # a complete entry is only mapped, read-only, an interrupted
+        # or missing one is opened as a store that resumes
+        cache = ResultCache()
+        cached = cache.get(analyzer)
+        if cached is None:
+            sink = cache.open(analyzer)
+    elif save_results and (analyzer.b_save_sf or analyzer.b_save_psd):
+        try:
+            sink = ResultStore.for_analyzer(analyzer.output_path, analyzer)
+        except (IOError, OSError) as error:
+            # e.g. the input is on a read-only share, the rows stay in memory
+            print("Not saving the rows to {0}: {1}".format(analyzer.output_path, error))
+
+    # events of the sound field band are written as they complete, one JSON object per line
+    detector = None
+    if event_threshold is not None:
+        def write_event(event):
+            events_file.write(json.dumps(event.to_dict()) + '\n')
+            events_file.flush()
+
+        detector = EventDetector.for_analyzer(analyzer, event_threshold, event_hysteresis * event_threshold,
+                                              event_min_duration, all_bands=False, callback=write_event)
+        # closed with the detector flushed below, also when the analysis fails
+        events_file = open(file_in + '_events.jsonl', 'w')
+
+    if cached is not None:
+        print("Loaded all {0} rows from the cache".format(num_rows))
+    elif isinstance(sink, ResultStore) and sink.is_complete():
+        print("Loaded all {0} rows from {1}".format(num_rows, sink.path))
+    elif isinstance(sink, ResultStore) and sink.count:
+        print("Resuming after row {0} of {1}".format(sink.count, num_rows))
+
+    try:
+        if cached is not None:
+            pyramid = SoundFieldPyramid.from_rows(cached)
+            if detector is not None:
+                detector.push_rows(cached)
+        elif events_only and not follow:
+            # batches of rows go to the detector in one small buffer, which
+            # the next batch overwrites
+            for first_row, rows in analyzer.iter_sound_field():
+                detector.push_rows(rows, first_row)
+        elif use_mmap and not animate and not follow:
+            # all frames in a few large batches
+            pyramid = SoundFieldPyramid.from_rows(analyzer.compute_sound_field(sink))
+            if detector is not None:
+                detector.push_rows(analyzer.sf)
         else:
-            mat[num_fft_half:] = array
-            iteration += 1
-
-        #print("mat size {0}".format(mat.shape))
-
-        # write this chunk to the "_original" file
-        # TODO
-        # it takes 2 iterations to have a set because the
-        # rolling step is half the size of an FFT process
-        if iteration > 1:
-            # insert the new values at the beginning of the results array
-            new_processed = analyzer.process_chunk(iteration, mat)
-
-            # roll the data down a row to insert new data
-            processed = np.roll(processed, 1, axis=0)
-            processed[0] = new_processed
-
-            #processed = np.insert(processed, 0, new_processed, 0)
-
-            if animate and (iteration % 5 == 0 or iteration, num_frames + 1):
-                #image.set_data(processed)
-                image = plt.imshow(processed, aspect='auto')
-                plt.draw()
-                plt.pause(0.01)
-                plt.clf()
+            if sink is None:
+                sink = ResultSink(num_rows, analyzer.num_samples, dtype=analyzer.get_dtype())
+            # a store's rows are in files, only the ones in memory count
+            if isinstance(sink, ResultWindow):
+                analyzer.profiler.set_buffer('sink', sink.buffer.nbytes)
+            elif not isinstance(sink, ResultStore):
+                analyzer.profiler.set_buffer('sink', sink.data.nbytes)
+
+            # downsampled levels for the final view, the window of the
+            # follow mode is small enough to draw as it is
+            if not follow:
+                pyramid = SoundFieldPyramid(analyzer.num_samples, analyzer.get_dtype(), base=sink.rows)
+                pyramid.add_rows(sink.rows())
+            if detector is not None and not follow:
+                detector.push_rows(sink.rows())
+
+            # frames of the rows already saved are skipped, except those
+            # the next row's PSD stack reaches back to
+            first_frame = 0
+            if sink.count:
+                first_frame = analyzer.get_row_shots(sink.count, num_rows, num_frames)[0] // analyzer.rolling_step
+            last_saved_frame = sink.count * analyzer.psd_stacking_factor
+
+            if follow:
+                frames = read_frames(reader, analyzer, follow=True, timeout=follow_timeout)
+            elif use_mmap:
+                # frames are strided views over the memory-mapped file,
+                # numbering starts at 2 to match the chunked reader below
+                data = analyzer.get_roi_data()[first_frame * analyzer.rolling_step:]
+
+                def decode(frame):
+                    # pages of the file are read when the frame is decoded
+                    with analyzer.profiler.stage('decode', shots=analyzer.rolling_step,
+                                                 bytes=analyzer.rolling_step * reader.get_shot_bytes()):
+                        frame = analyzer.decoder.decode(frame)
+                    if analyzer.binner.enabled:
+                        with analyzer.profiler.stage('bin', shots=analyzer.rolling_step):
+                            frame = analyzer.binner.bin(frame)
+                    return frame
+
+                frames = enumerate((decode(frame) for frame in
+                                    reader.frame_view(data, num_fft, analyzer.rolling_step)), 2 + first_frame)
+            else:
+                frames = read_frames(reader, analyzer, first_frame)
+
+            if not follow and sink.count >= num_rows:
+                frames = []
+
+            live = LiveView(analyzer.num_samples, max_fps=max_fps) if animate else None
+
+            def compute():
+                for iteration, mat in frames:
+                    if follow:
+                        print("{0}".format(iteration))
+                    else:
+                        print("{0} of {1}".format(iteration, num_frames + 1))
+
+                    new_processed = analyzer.process_chunk(iteration, mat)
+                    if new_processed is None or iteration - 1 <= last_saved_frame:
+                        # still stacking PSDs, or a row saved before, no new row yet
+                        continue
+
+                    with analyzer.profiler.stage('sink', bytes=new_processed.nbytes):
+                        if isinstance(sink, ResultStore):
+                            sink.append(new_processed, analyzer.get_view_psd() if sink.psd is not None else None)
+                        else:
+                            sink.append(new_processed)
+                        if pyramid is not None:
+                            pyramid.append(new_processed)
+                    if detector is not None:
+                        detector.push(new_processed)
+
+                    if live is not None:
+                        # only the newest rows at the time of a redraw are drawn
+                        live.put(sink.newest_first)
+
+            if live is None:
+                compute()
+            else:
+                # frames are computed in a thread while the plot redraws
+                live.run(compute)
+    finally:
+        if detector is not None:
+            # events still going on when the capture ends, or when the
+            # analysis failed
+            detector.flush()
+            events_file.close()
 
     end = time.time()
 
     print(bcolors.OKBLUE)
     print ("Total Elapsed Time: {0}".format(end - start))
 
+    if profile:
+        analyzer.profiler.write_json(file_in + '_profile.json',
+                                     {'file': file_in, 'settings': analyzer.get_result_params()})
+        print(analyzer.profiler.format())
+
     print(bcolors.ENDC)
 
-    plt.imshow(processed, aspect='auto')
+    if isinstance(sink, ResultStore):
+        sink.close()
+
+    if events_only and not follow:
+        print("Events written to {0}".format(events_file.name))
+        return
+
+    from matplotlib import pyplot as plt
+
+    if pyramid is None:
+        plt.imshow(sink.newest_first(), aspect='auto')
+    else:
+        # only as much of the sound field as fits in view_shape, newest row on top
+        tile, level, extent = pyramid.get_view(max_shape=view_shape)
+        plt.imshow(tile[::-1], aspect='auto', extent=(extent[2], extent[3], extent[0], extent[1]))
     plt.colorbar()
     plt.show()
 
@@ -133,4 +350,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
\ No newline at end of file
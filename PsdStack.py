@@ -0,0 +1,50 @@
+"""
+Rolling PSD stack
+"""
+
+import numpy
+
+
+class PsdStack(object):
+    """
+    Running sum of the PSDs of the last `size` frames.  Adding a frame
+    costs O(bins x channels) however large the stack is: the new PSD is
+    added to the sum and the one that falls out of the window is
+    subtracted.  The sum is rebuilt from the kept frames every `size`
+    frames so rounding errors don't build up over long runs.
+    """
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.frames = None  # ring buffer of the last `size` PSDs
+        self.total = None
+        self.count = 0  # number of frames added since the last reset
+
+    def reset(self):
+        self.frames = None
+        self.total = None
+        self.count = 0
+
+    def add(self, psd):
+        """
+        Add the PSD of the next frame to the stack
+        :param psd: (bins x channels) PSD
+        :return: (bins x channels) sum of the last `size` PSDs
+        """
+        if self.frames is None:
+            self.frames = numpy.zeros((self.size,) + psd.shape, dtype=psd.dtype)
+            self.total = numpy.zeros(psd.shape, dtype=psd.dtype)
+
+        slot = self.count % self.size
+        if self.count >= self.size:
+            self.total -= self.frames[slot]
+
+        self.frames[slot] = psd
+        self.total += psd
+        self.count += 1
+
+        if self.count % self.size == 0:
+            # the ring is in frame order again, rebuild the exact sum
+            self.frames.sum(axis=0, out=self.total)
+
+        return self.total
@@ -1,6 +1,43 @@
 __author__ = 'o1806'
 
+import os
+import threading
+import time
+from timeit import default_timer
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 from FdsHeader import FdsHeader
+from Profiler import Profiler
+
+
+# numpy types of the DataEncoding values used in FDS headers
+DATA_TYPES = {
+    'uint16': numpy.uint16,
+    'float32': numpy.float32,
+    'real32': numpy.float32,
+    'single': numpy.float32,
+    'real64': numpy.float64,
+    'double': numpy.float64,
+}
+
+
+def get_data_type(encoding):
+    """
+    Get the numpy data type of the samples in an FDS data section
+    :param encoding: The DataEncoding value from the header
+    :return: numpy dtype of a single sample
+    """
+    try:
+        return numpy.dtype(DATA_TYPES[encoding.strip().lower()])
+    except KeyError:
+        raise Exception("ReadFDS:UnknownEncoding\nUnsupported data encoding: {0}".format(encoding))
 
 
 class ReadFDS(object):
@@ -15,19 +52,246 @@ class ReadFDS(object):
         self.file_out = file_out
         self.mat = None
         self.header = None
+        self.profiler = Profiler(enabled=False)  # enable to time reading, see Profiler
+
+    def __getstate__(self):
+        # don't pickle the mapped data, worker processes map the file again
+        state = self.__dict__.copy()
+        state['mat'] = None
+        return state
 
-    def read_header(self):
+    def read_header(self, catalog=None):
         """
         Get basic information from the header so we know
         where the data starts and information about the data
+        :param catalog: Optional FdsCatalog, its copy of the header is
+                        used unless the file changed since it was indexed
         :return:
         """
+        if catalog is not None:
+            self.header = catalog.get_header(self.file_in)
+            return
+
         self.header = FdsHeader(debug=False)
-        self.header.process(self.file_in)
+        with self.profiler.stage('header'):
+            self.header.process(self.file_in)
 
-    def read_chunks(self, data_start_loc, chunk_size):
+    def read_chunks(self, data_start_loc, chunk_size, stop=None):
+        """
+        Read the file in chunks
+        :param data_start_loc: Byte offset of the first chunk
+        :param chunk_size: Number of bytes in a chunk
+        :param stop: Byte offset to stop reading at, None for the end of the file
+        :return: generator of chunks, the last one may be short
+        """
         with open(self.file_in, 'rb') as in_file:
             in_file.seek(data_start_loc)
+            position = data_start_loc
+
+            while stop is None or position < stop:
+                size = chunk_size if stop is None else min(chunk_size, stop - position)
+                start = default_timer()
+                chunk = in_file.read(size)
+                self.profiler.add('read', default_timer() - start, bytes=len(chunk))
+                if not chunk:
+                    break
 
-            for chunk in iter(lambda: in_file.read(chunk_size), ''):
+                position += len(chunk)
                 yield chunk
+
+    def prefetch_chunks(self, data_start_loc, chunk_size, depth=2, stop=None):
+        """
+        Same chunks as read_chunks, but a background thread reads up to
+        `depth` chunks ahead with readinto while the caller works on the
+        current one.  Only depth + 1 buffers are ever allocated, they are
+        recycled, so a chunk is only valid until the generator continues
+        :param data_start_loc: Byte offset of the first chunk
+        :param chunk_size: Number of bytes in a chunk
+        :param depth: Number of chunks to read ahead
+        :param stop: Byte offset to stop reading at, None for the end of the file
+        :return: generator of uint8 arrays over the buffers, the last one
+                 may be short
+        """
+        free = queue.Queue()
+        filled = queue.Queue()
+        for _ in range(depth + 1):
+            free.put(bytearray(chunk_size))
+        self.profiler.set_buffer('read', (depth + 1) * chunk_size)
+
+        def fill():
+            try:
+                with open(self.file_in, 'rb') as in_file:
+                    in_file.seek(data_start_loc)
+                    position = data_start_loc
+
+                    while True:
+                        buf = free.get()
+                        if buf is None:
+                            # the reader was closed
+                            return
+
+                        start = default_timer()
+                        if stop is not None and stop - position < chunk_size:
+                            count = in_file.readinto(memoryview(buf)[:max(stop - position, 0)]) or 0
+                        else:
+                            count = in_file.readinto(buf) or 0
+                        self.profiler.add('read', default_timer() - start, bytes=count)
+                        position += count
+
+                        filled.put((buf, count))
+                        if count < chunk_size:
+                            return
+            except Exception as e:
+                filled.put((e, 0))
+
+        thread = threading.Thread(target=fill)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                buf, count = filled.get()
+                if isinstance(buf, Exception):
+                    raise buf
+                if count == 0:
+                    break
+
+                # an array rather than a memoryview, numpy can't read
+                # memoryviews on Python 2
+                yield numpy.frombuffer(buf, dtype=numpy.uint8, count=count)
+
+                # the caller is done with this chunk, it can be filled again
+                free.put(buf)
+
+                if count < chunk_size:
+                    break
+        finally:
+            free.put(None)
+            thread.join()
+            self.profiler.set_buffer('read', 0)
+
+    def follow_chunks(self, data_start_loc, chunk_size, poll_interval=0.1, timeout=None, stop=None):
+        """
+        Read the file in chunks while it is still being written.  Only
+        complete chunks are returned, when the file doesn't hold the next
+        one yet this waits for it to grow.  A single buffer is reused for
+        every chunk, so a chunk is only valid until the generator continues
+        :param data_start_loc: Byte offset of the first chunk
+        :param chunk_size: Number of bytes in a chunk
+        :param poll_interval: Seconds between two checks of the file size
+        :param timeout: Seconds without a new chunk after which the file
+                        is considered complete, None to wait forever
+        :param stop: Byte offset to stop reading at, None for no limit
+        :return: generator of uint8 arrays over the buffer
+        """
+        buf = bytearray(chunk_size)
+        self.profiler.set_buffer('read', chunk_size)
+
+        with open(self.file_in, 'rb') as in_file:
+            in_file.seek(data_start_loc)
+            position = data_start_loc
+            last_chunk = time.time()
+
+            while stop is None or position < stop:
+                size = chunk_size if stop is None else min(chunk_size, stop - position)
+
+                if os.fstat(in_file.fileno()).st_size - position < size:
+                    # the writer hasn't finished the next chunk yet
+                    if timeout is not None and time.time() - last_chunk > timeout:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                start = default_timer()
+                count = in_file.readinto(memoryview(buf)[:size]) or 0
+                self.profiler.add('read', default_timer() - start, bytes=count)
+                if count == 0:
+                    break
+
+                position += count
+                last_chunk = time.time()
+                yield numpy.frombuffer(buf, dtype=numpy.uint8, count=count)
+
+    def get_data_type(self):
+        """
+        Get the numpy data type of the samples in this file
+        :return: numpy dtype
+        """
+        return get_data_type(self.header.data_encoding)
+
+    def get_shot_bytes(self):
+        """
+        Number of bytes in one shot (a row of num_rows samples)
+        :return: int
+        """
+        return self.get_data_type().itemsize * self.header.num_rows
+
+    def get_shot_offset(self, shot):
+        """
+        Byte offset of a shot in the file
+        :param shot: 0-based shot index
+        :return: int
+        """
+        return self.header.data_start_loc + int(shot) * self.get_shot_bytes()
+
+    def get_num_shots(self):
+        """
+        Number of complete shots (rows of num_rows samples) in the data section
+        :return: int
+        """
+        return max(self.header.file_size - self.header.data_start_loc, 0) // self.get_shot_bytes()
+
+    def map_data(self):
+        """
+        Memory-map the data section as a (shots x channels) array.
+        Nothing is copied, pages are only read from disk when the
+        array is indexed
+        :return: read only numpy.memmap, also kept in self.mat
+        """
+        if self.header is None:
+            self.read_header()
+
+        dtype = self.get_data_type()
+        num_shots = self.get_num_shots()
+
+        if num_shots == 0:
+            # numpy can't map an empty region
+            self.mat = numpy.empty((0, self.header.num_rows), dtype=dtype)
+        else:
+            self.mat = numpy.memmap(self.file_in, dtype=dtype, mode='r',
+                                    offset=self.header.data_start_loc,
+                                    shape=(num_shots, self.header.num_rows))
+
+        return self.mat
+
+    def read_frames(self, num_fft, rolling_step):
+        """
+        Overlapping FFT frames straight over the memory-mapped data
+        :param num_fft: Number of shots in a frame
+        :param rolling_step: Number of shots between the start of two frames
+        :return: (frames x num_fft x channels) read only view
+        """
+        if self.mat is None:
+            self.map_data()
+
+        return self.frame_view(self.mat, num_fft, rolling_step)
+
+    @staticmethod
+    def frame_view(data, num_fft, rolling_step):
+        """
+        Make a (frames x num_fft x channels) view of a (shots x channels)
+        array without copying it.  Frame i starts at shot i * rolling_step,
+        incomplete frames at the end are dropped
+        :param data: (shots x channels) array
+        :param num_fft: Number of shots in a frame
+        :param rolling_step: Number of shots between the start of two frames
+        :return: read only strided view of data
+        """
+        num_fft = int(num_fft)
+        rolling_step = int(rolling_step)
+        num_frames = max((data.shape[0] - num_fft) // rolling_step + 1, 0)
+        shot_stride, channel_stride = data.strides
+
+        return as_strided(data, shape=(num_frames, num_fft, data.shape[1]),
+                          strides=(shot_stride * rolling_step, shot_stride, channel_stride),
+                          writeable=False)
@@ -0,0 +1,153 @@
+"""
+Cache of sound fields computed before
+
+Every entry is a ResultStore in a directory named after a hash of the
+input file's identity (path, size, mtime and header) and of the
+analysis parameters the result depends on.  Display settings such as
+dpsd_c_rng or dsnr_y_rng are not part of the key, so changing them
+reopens the same entry, which is only memory-mapped, not recomputed.
+An entry that was interrupted is resumed like any ResultStore.  The
+least recently used entries are removed when the cache outgrows max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy
+
+from ResultSink import ResultStore
+
+
+class ResultCache(object):
+
+    def __init__(self, path=None, max_bytes=4 * 1024 ** 3):
+        """
+        :param path: Directory of the cache, defaults to ~/.spectral_analysis/cache
+        :param max_bytes: Size the entries are trimmed to, least recently used first
+        """
+        self.path = path or os.path.join(os.path.expanduser('~'), '.spectral_analysis', 'cache')
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def get_params(analyzer):
+        """
+        Everything an analyzer's sound field depends on, its settings and
+        the identity of its input file
+        :param analyzer: SpectralAnalysis
+        :return: JSON-serializable dict
+        """
+        header = json.dumps(analyzer.reader.header.to_dict(), sort_keys=True).encode('utf-8')
+
+        params = analyzer.get_result_params()
+        params['header'] = hashlib.sha1(header).hexdigest()
+
+        return params
+
+    def get_key(self, analyzer):
+        """
+        :param analyzer: SpectralAnalysis
+        :return: hex digest naming the analyzer's entry
+        """
+        params = json.dumps(self.get_params(analyzer), sort_keys=True).encode('utf-8')
+
+        return hashlib.sha1(params).hexdigest()
+
+    def open(self, analyzer):
+        """
+        The entry of an analyzer's current settings, created when there
+        is none.  It is complete (is_complete()) when it was computed
+        before, otherwise compute_sound_field fills in the missing rows
+        :param analyzer: SpectralAnalysis
+        :return: ResultStore
+        """
+        key = self.get_key(analyzer)
+        store = ResultStore.for_analyzer(os.path.join(self.path, key), analyzer, self.get_params(analyzer))
+
+        # the modification time of an entry is its last use
+        os.utime(store.path, None)
+        self.evict(keep=key)
+
+        return store
+
+    def get(self, analyzer):
+        """
+        Sound field of an analyzer's current settings if it was computed before
+        :param analyzer: SpectralAnalysis
+        :return: (rows x channels) memmap, None if it isn't cached
+        """
+        entry = os.path.join(self.path, self.get_key(analyzer))
+
+        # the index is only read, an entry that is missing or incomplete
+        # is left as it is, unlike opening a ResultStore on it
+        try:
+            with open(os.path.join(entry, ResultStore.INDEX_FILE)) as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        params = json.loads(json.dumps(self.get_params(analyzer)))
+        num_rows = analyzer.get_num_rows(analyzer.num_frames)
+        if index.get('params') != params or index.get('num_rows') != num_rows or \
+                index.get('num_channels') != analyzer.num_samples or index.get('count', 0) < num_rows:
+            return None
+
+        try:
+            data = numpy.load(os.path.join(entry, ResultStore.SF_FILE), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+        if data.shape != (num_rows, analyzer.num_samples) or data.dtype != numpy.dtype(analyzer.get_dtype()):
+            return None
+
+        os.utime(entry, None)
+
+        return data
+
+    def get_entries(self):
+        """
+        :return: list of (last use, bytes, key), least recently used first
+        """
+        entries = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if not os.path.isdir(entry):
+                continue
+
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        :param keep: Key of an entry to never remove, e.g. the one in use
+        :return: number of entries removed
+        """
+        entries = self.get_entries()
+        total = sum(size for _, size, _ in entries)
+
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+            removed += 1
+
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry
+        :return:
+        """
+        for _, _, key in self.get_entries():
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
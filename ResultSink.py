@@ -0,0 +1,245 @@
+"""
+Destinations for sound field rows
+"""
+
+import json
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+
+
+class ResultSink(object):
+    """
+    Preallocated in-memory sound field.  Rows are written in order at the
+    next free index, so adding a row never moves the ones before it
+    """
+
+    def __init__(self, num_rows, num_channels, dtype=numpy.float64):
+        self.data = numpy.zeros((num_rows, num_channels), dtype=dtype)
+        self.count = 0  # rows written so far
+
+    def append(self, row):
+        """
+        Write the next row
+        :param row: (channels,) array
+        :return: index of the row
+        """
+        if self.count >= self.data.shape[0]:
+            raise Exception("ResultSink:Full\nAll {0} rows are already written".format(self.data.shape[0]))
+
+        self.data[self.count] = row
+        self.count += 1
+
+        return self.count - 1
+
+    def rows(self):
+        """
+        :return: view of the rows written so far, oldest first
+        """
+        return self.data[:self.count]
+
+    def newest_first(self):
+        """
+        :return: view of the rows written so far, newest first
+        """
+        return self.data[:self.count][::-1]
+
+
+class ResultWindow(object):
+    """
+    The newest num_rows sound field rows, for captures of unknown length.
+    Like FrameAssembler every row is written twice, at i % num_rows and
+    at i % num_rows + num_rows, so the window is always a contiguous
+    slice of the buffer and memory use doesn't grow with the capture
+    """
+
+    def __init__(self, num_rows, num_channels, dtype=numpy.float64):
+        self.num_rows = int(num_rows)
+        self.buffer = numpy.zeros((2 * self.num_rows, num_channels), dtype=dtype)
+        self.count = 0  # rows written so far, including the ones dropped
+
+    def append(self, row):
+        """
+        Write the next row, dropping the oldest one when the window is full
+        :param row: (channels,) array
+        :return: index of the row since the start of the capture
+        """
+        i = self.count % self.num_rows
+        self.buffer[i] = row
+        self.buffer[i + self.num_rows] = row
+        self.count += 1
+
+        return self.count - 1
+
+    def rows(self):
+        """
+        :return: view of the rows in the window, oldest first
+        """
+        end = self.count % self.num_rows + self.num_rows
+
+        return self.buffer[end - min(self.count, self.num_rows):end]
+
+    def newest_first(self):
+        """
+        :return: view of the rows in the window, newest first
+        """
+        return self.rows()[::-1]
+
+
+class ResultStore(object):
+    """
+    Sound field on disk, for runs too long to keep in memory or to redo.
+    Rows go to sound_field.npy and, when psd_bins is given, the PSD
+    behind each row to psd.npy, both written in place through a memmap
+    so numpy.load(mmap_mode='r') reads them while the analysis runs.
+    index.json records the analysis parameters and how many rows are
+    complete.  Opening a store again with the same parameters resumes
+    after the last completed row instead of starting over
+    """
+
+    SF_FILE = 'sound_field.npy'
+    PSD_FILE = 'psd.npy'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, path, num_rows, num_channels, params, dtype=numpy.float64, psd_bins=None,
+                 checkpoint_rows=256):
+        """
+        :param path: Directory of the store, created if missing
+        :param num_rows: Total number of sound field rows
+        :param num_channels: Number of channels in a row
+        :param params: JSON-serializable dict of everything the rows depend on
+        :param dtype: dtype of the rows
+        :param psd_bins: Number of PSD bins saved per row, None to not save the PSD
+        :param checkpoint_rows: Rows appended between two index updates
+        """
+        self.path = path
+        self.checkpoint_rows = checkpoint_rows
+        self.index = {
+            # as it reads back from the file, tuples become lists etc.
+            'params': json.loads(json.dumps(params)),
+            'num_rows': int(num_rows),
+            'num_channels': int(num_channels),
+            'dtype': numpy.dtype(dtype).str,
+            'psd_bins': None if psd_bins is None else int(psd_bins),
+            'count': 0,
+        }
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        sf_shape = (num_rows, num_channels)
+        psd_shape = None if psd_bins is None else (num_rows, psd_bins, num_channels)
+
+        saved = self.read_index()
+        if saved is not None and dict(saved, count=0) == self.index:
+            # same analysis as before, keep the rows it completed
+            mode = 'r+'
+            self.index['count'] = saved['count']
+        else:
+            mode = 'w+'
+
+        self.data = open_memmap(self.get_file(self.SF_FILE), mode=mode, dtype=dtype, shape=sf_shape)
+        self.psd = None
+        if psd_shape is not None:
+            self.psd = open_memmap(self.get_file(self.PSD_FILE), mode=mode, dtype=dtype, shape=psd_shape)
+
+        self.count = self.index['count']  # rows written so far
+        if mode == 'w+':
+            self.write_index()
+
+    @classmethod
+    def for_analyzer(cls, path, analyzer, params=None):
+        """
+        Store for the sound field of a SpectralAnalysis' ROI, and for the
+        PSD of the displayed range when b_save_psd is set
+        :param path: Directory of the store
+        :param analyzer: SpectralAnalysis
+        :param params: Parameters the rows depend on, defaults to get_result_params()
+        :return: ResultStore
+        """
+        return cls(path, analyzer.get_num_rows(analyzer.num_frames), analyzer.num_samples,
+                   params or analyzer.get_result_params(), dtype=analyzer.get_dtype(),
+                   psd_bins=analyzer.get_num_view_bins() if analyzer.b_save_psd else None)
+
+    def get_file(self, name):
+        return os.path.join(self.path, name)
+
+    def read_index(self):
+        """
+        :return: the saved index, None if there is none or it can't be read
+        """
+        try:
+            with open(self.get_file(self.INDEX_FILE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_index(self):
+        # write a new file and rename it over the old one, a run killed
+        # halfway through leaves either index whole
+        tmp = self.get_file(self.INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(self.get_file(self.INDEX_FILE)):
+            os.remove(self.get_file(self.INDEX_FILE))
+        os.rename(tmp, self.get_file(self.INDEX_FILE))
+
+    def checkpoint(self, count=None):
+        """
+        Flush the rows to disk, then record them as complete
+        :param count: Number of complete rows, defaults to the rows appended
+        :return:
+        """
+        if count is not None:
+            self.count = count
+
+        self.data.flush()
+        if self.psd is not None:
+            self.psd.flush()
+
+        self.index['count'] = int(self.count)
+        self.write_index()
+
+    def is_complete(self):
+        return self.count >= self.data.shape[0]
+
+    def append(self, row, psd=None):
+        """
+        Write the next row, the index is updated every checkpoint_rows rows
+        :param row: (channels,) array
+        :param psd: (psd_bins x channels) PSD of the row, if the store saves it
+        :return: index of the row
+        """
+        if self.count >= self.data.shape[0]:
+            raise Exception("ResultStore:Full\nAll {0} rows are already written".format(self.data.shape[0]))
+
+        self.data[self.count] = row
+        if self.psd is not None and psd is not None:
+            self.psd[self.count] = psd
+        self.count += 1
+
+        if self.count % self.checkpoint_rows == 0 or self.is_complete():
+            self.checkpoint()
+
+        return self.count - 1
+
+    def close(self):
+        """
+        Record the rows appended since the last checkpoint
+        :return:
+        """
+        if self.count != self.index['count']:
+            self.checkpoint()
+
+    def rows(self):
+        """
+        :return: view of the rows written so far, oldest first
+        """
+        return self.data[:self.count]
+
+    def newest_first(self):
+        """
+        :return: view of the rows written so far, newest first
+        """
+        return self.data[:self.count][::-1]
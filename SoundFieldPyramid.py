@@ -0,0 +1,238 @@
+"""
+Downsampled copies of the sound field for viewing it at any zoom
+"""
+
+import numpy
+
+
+class SoundFieldPyramid(object):
+    """
+    Levels of the sound field reduced 2x, 4x, 8x... over both time (rows)
+    and distance (channels), built as the rows arrive.  Each level keeps
+    the max and the mean of the blocks of the level below, so a viewer
+    draws at most about one pixel per block whatever the zoom, and faint
+    events survive the reduction in the max.  Together the levels take a
+    third of the memory of the full resolution rows per reduction.
+
+    Level 0 is the full resolution, held by whoever appends the rows,
+    e.g. a ResultSink.  A trailing row or channel without a partner is
+    reduced on its own, so every level covers all rows and channels.
+    """
+
+    REDUCTIONS = ('max', 'mean')
+
+    def __init__(self, num_channels, dtype=numpy.float64, base=None):
+        """
+        :param num_channels: Channels of a full resolution row
+        :param dtype: dtype of the levels
+        :param base: Optional (rows x channels) array or callable returning
+                     it, the full resolution rows served as level 0
+        """
+        self.num_channels = int(num_channels)
+        self.dtype = numpy.dtype(dtype)
+        self.base = base
+        self.count = 0  # full resolution rows added so far
+
+        # per level from 1: {'max': array, 'mean': array, 'count': rows}
+        # and the row of the level below waiting for its partner
+        self.levels = []
+        self.pending = []
+
+    @classmethod
+    def from_rows(cls, rows, base=None):
+        """
+        Pyramid of a complete sound field
+        :param rows: (rows x channels) array
+        :param base: level 0, defaults to rows
+        :return: SoundFieldPyramid
+        """
+        pyramid = cls(rows.shape[1], rows.dtype, rows if base is None else base)
+        pyramid.add_rows(rows)
+
+        return pyramid
+
+    def get_level_shape(self, level, num_rows=None):
+        """
+        :param level: 0 for full resolution
+        :param num_rows: Full resolution rows, defaults to the rows added
+        :return: (rows, channels) of the level once every pair is reduced
+        """
+        num_rows = self.count if num_rows is None else num_rows
+        scale = 1 << level
+
+        return -(-num_rows // scale), -(-self.num_channels // scale)
+
+    def append(self, row):
+        """
+        Add the next full resolution row
+        :param row: (channels,) array
+        :return:
+        """
+        self.add_rows(numpy.asarray(row)[numpy.newaxis])
+
+    def add_rows(self, rows):
+        """
+        Add full resolution rows, all pairs they complete are reduced at once
+        :param rows: (rows x channels) array
+        :return:
+        """
+        self.count += rows.shape[0]
+        self.reduce(0, rows, rows)
+
+    def reduce(self, level, row_max, row_mean):
+        """
+        Reduce rows of a level into the level above it
+        :param level: Level of the rows
+        :param row_max: (rows x channels) max of the level's blocks
+        :param row_mean: (rows x channels) mean of the level's blocks
+        :return:
+        """
+        if len(self.pending) <= level:
+            self.pending.append(None)
+
+        # complete the pair left over from before
+        if self.pending[level] is not None:
+            row_max = numpy.concatenate((self.pending[level][0], row_max))
+            row_mean = numpy.concatenate((self.pending[level][1], row_mean))
+            self.pending[level] = None
+
+        num_pairs = row_max.shape[0] // 2
+        if row_max.shape[0] % 2:
+            self.pending[level] = (row_max[-1:].copy(), row_mean[-1:].copy())
+        if num_pairs == 0:
+            return
+
+        reduced_max, reduced_mean = self.reduce_blocks(row_max[:2 * num_pairs], row_mean[:2 * num_pairs], 2)
+        self.store(level + 1, reduced_max, reduced_mean)
+        self.reduce(level + 1, reduced_max, reduced_mean)
+
+    @staticmethod
+    def reduce_blocks(row_max, row_mean, num_rows):
+        """
+        Max and mean of blocks of num_rows rows and 2 channels
+        :param row_max: (rows x channels), rows a multiple of num_rows
+        :param row_mean: (rows x channels) shaped like row_max
+        :param num_rows: Rows in a block, 1 or 2
+        :return: (max, mean) of (rows / num_rows x ceil(channels / 2))
+        """
+        num_channels = row_max.shape[1]
+        shape = (-1, num_rows, num_channels)
+
+        row_max = row_max.reshape(shape).max(axis=1)
+        row_mean = row_mean.reshape(shape).mean(axis=1)
+
+        # pairs of channels, the last one alone when the count is odd
+        starts = numpy.arange(0, num_channels, 2)
+        widths = numpy.minimum(num_channels - starts, 2)
+
+        return (numpy.maximum.reduceat(row_max, starts, axis=1),
+                numpy.add.reduceat(row_mean, starts, axis=1) / widths)
+
+    def store(self, level, row_max, row_mean):
+        """
+        Append reduced rows to a level, doubling its capacity when it is full
+        :param level: Level from 1
+        :return:
+        """
+        while len(self.levels) < level:
+            num_channels = self.get_level_shape(len(self.levels) + 1)[1]
+            self.levels.append({'count': 0,
+                                'max': numpy.empty((16, num_channels), dtype=self.dtype),
+                                'mean': numpy.empty((16, num_channels), dtype=self.dtype)})
+
+        entry = self.levels[level - 1]
+        count = entry['count'] + row_max.shape[0]
+        if count > entry['max'].shape[0]:
+            capacity = max(count, 2 * entry['max'].shape[0])
+            for name in self.REDUCTIONS:
+                grown = numpy.empty((capacity, entry[name].shape[1]), dtype=self.dtype)
+                grown[:entry['count']] = entry[name][:entry['count']]
+                entry[name] = grown
+
+        entry['max'][entry['count']:count] = row_max
+        entry['mean'][entry['count']:count] = row_mean
+        entry['count'] = count
+
+    def get_num_levels(self):
+        """
+        :return: number of levels including level 0
+        """
+        return len(self.levels) + 1
+
+    def get_level(self, level, reduction='max'):
+        """
+        All rows of a level, including the trailing rows still waiting
+        for a partner, reduced on their own
+        :param level: 0 for full resolution
+        :param reduction: 'max' or 'mean'
+        :return: (rows x channels) array, a view unless trailing rows are added
+        """
+        if reduction not in self.REDUCTIONS:
+            raise Exception("SoundFieldPyramid:UnknownReduction\n"
+                            "reduction must be one of {0}".format(', '.join(self.REDUCTIONS)))
+
+        if level == 0:
+            base = self.base() if callable(self.base) else self.base
+            if base is None:
+                raise Exception("SoundFieldPyramid:NoBase\nThe full resolution rows weren't given")
+            return base[:self.count]
+
+        rows = self.levels[level - 1][reduction][:self.levels[level - 1]['count']] \
+            if level <= len(self.levels) else numpy.empty((0, self.get_level_shape(level)[1]), self.dtype)
+
+        # the rows waiting at each level below, carried up one level at a time
+        tail_max = tail_mean = None
+        for below in range(level):
+            pending = self.pending[below] if below < len(self.pending) else None
+            if pending is not None:
+                tail_max = pending[0] if tail_max is None else numpy.concatenate((pending[0], tail_max))
+                tail_mean = pending[1] if tail_mean is None else numpy.concatenate((pending[1], tail_mean))
+            if tail_max is not None:
+                tail_max, tail_mean = self.reduce_blocks(tail_max, tail_mean, tail_max.shape[0])
+
+        if tail_max is None:
+            return rows
+
+        return numpy.concatenate((rows, tail_max if reduction == 'max' else tail_mean))
+
+    def choose_level(self, num_rows, num_channels, max_shape):
+        """
+        Finest level at which a region fits in max_shape
+        :param num_rows: Full resolution rows of the region
+        :param num_channels: Full resolution channels of the region
+        :param max_shape: (rows, channels), e.g. the pixels of the view
+        :return: level
+        """
+        level = 0
+        while (-(-num_rows // (1 << level)) > max_shape[0] or -(-num_channels // (1 << level)) > max_shape[1]) \
+                and (1 << level) < max(num_rows, num_channels):
+            level += 1
+
+        return level
+
+    def get_view(self, row_rng=None, channel_rng=None, max_shape=(1024, 1024), reduction='max'):
+        """
+        A region of the sound field at the finest level that fits in
+        max_shape, so the cost of drawing it doesn't depend on its size
+        :param row_rng: [first last) full resolution rows, None for all
+        :param channel_rng: [first last) full resolution channels, None for all
+        :param max_shape: Largest (rows, channels) wanted
+        :param reduction: 'max' or 'mean'
+        :return: (array, level, (first row, last row, first channel,
+                 last channel)) the full resolution extent the array covers
+        """
+        row_rng = row_rng or (0, self.count)
+        channel_rng = channel_rng or (0, self.num_channels)
+
+        level = self.choose_level(row_rng[1] - row_rng[0], channel_rng[1] - channel_rng[0], max_shape)
+
+        # whole blocks that cover the region
+        scale = 1 << level
+        rows = slice(row_rng[0] // scale, -(-row_rng[1] // scale))
+        channels = slice(channel_rng[0] // scale, -(-channel_rng[1] // scale))
+
+        tile = self.get_level(level, reduction)[rows, channels]
+        extent = (rows.start * scale, min(rows.stop * scale, self.count),
+                  channels.start * scale, min(channels.stop * scale, self.num_channels))
+
+        return tile, level, extent
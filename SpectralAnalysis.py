@@ -4,10 +4,78 @@ Spectral Analysis
 
 import numpy
 import math
+import multiprocessing
+import os
 import re
+from multiprocessing.pool import ThreadPool
+
+from ChannelBinner import ChannelBinner
+from DataDecoder import DataDecoder
+from FdsHeader import parse_timestamp
+from ReadFDS import ReadFDS, get_data_type
+import ParallelProcessor
+from PsdStack import PsdStack
+from NoiseFloor import NoiseFloorEstimator
+
+try:
+    # single precision FFTs where numpy only computes them in double
+    from scipy import fftpack
+except ImportError:
+    fftpack = None
+
+# numpy.fft keeps float32 in single precision since numpy 2.0, before
+# it returns complex128 for every input
+NUMPY_SINGLE_FFT = numpy.fft.rfft(numpy.zeros(2, dtype=numpy.float32)).dtype == numpy.complex64
+
+
+def get_rfft_dtype(dtype):
+    """
+    :param dtype: float type of the frames
+    :return: complex type of their rfft
+    """
+    if numpy.dtype(dtype) == numpy.float32 and (NUMPY_SINGLE_FFT or fftpack is not None):
+        return numpy.dtype(numpy.complex64)
+
+    return numpy.dtype(numpy.complex128)
+
+
+def rfft(frames, n, axis=-1):
+    """
+    numpy.fft.rfft, in single precision for float32 frames.  Where
+    numpy computes those in double, scipy.fftpack's real FFT is used and
+    its packed [y0, Re y1, Im y1, ..., Re y(n / 2)] output unpacked into
+    the n / 2 + 1 complex bins
+    :param frames: Array of frames
+    :param n: Length of the FFT
+    :param axis: Axis of the frames to transform
+    :return: spectrum of get_rfft_dtype(frames.dtype)
+    """
+    if frames.dtype != numpy.float32 or NUMPY_SINGLE_FFT or fftpack is None:
+        return numpy.fft.rfft(frames, n, axis=axis)
+
+    packed = numpy.moveaxis(fftpack.rfft(frames, n, axis=axis), axis, 0)
+
+    spectrum = numpy.zeros((n // 2 + 1,) + packed.shape[1:], dtype=numpy.complex64)
+    spectrum.real[0] = packed[0]
+    spectrum.real[1:] = packed[1::2]
+    spectrum.imag[1:1 + (n - 1) // 2] = packed[2::2]
+
+    return numpy.moveaxis(spectrum, 0, axis)
 
 
 class SpectralAnalysis(object):
+
+    # smallest share of a batch worth handing to its own thread
+    MIN_THREAD_CHANNELS = 16
+    MIN_THREAD_SAMPLES = 1 << 20
+
+    # a DFT of fewer bins than this times log2(num_fft) beats the full FFT
+    DFT_BINS_PER_LOG2 = 4
+
+    # fraction of a shot by which times may miss it and still count as
+    # that shot, epoch seconds only have a few microseconds of precision
+    SHOT_TOLERANCE = 0.01
+
     def __init__(self, reader):
         self.reader = reader  # contains data from fds file
         self.rdf = reader.file_in  # link to RawDataFile
@@ -24,47 +92,59 @@ class SpectralAnalysis(object):
         m = re.match(r'(?P<value>([\d\.e\-]+))(?P<unit>([MV|mV|mv|V|v]+)$)', self.daq_card_range)
         if m.group('unit').lower() == 'mv':
             # convert
-            self.daq_card_range = int(m.group('value')) * 1e-3
+            self.daq_card_range = float(m.group('value')) * 1e-3
         else:
-            self.daq_card_range = int(m.group('value'))
+            self.daq_card_range = float(m.group('value'))
 
         self.header_size_bytes = int(reader.header.values["HeaderSize_Bytes"])
         self.encoding = reader.header.values["DataEncoding"]
+        self.precision = 'double'  # 'double' or 'single', change with set_precision
+        self.decoder = DataDecoder(self.encoding, self.daq_card_range)  # raw samples to volts
         self.shots_size = math.floor((reader.header.file_size - self.header_size_bytes) /
                                      (self.num_samples * self.get_data_type_byte_size(self.encoding)))
 
         self.position_first_sample = float(reader.header.values["PositionOfFirstSample_m"])
-        self.sp_rng = [1, self.num_samples]  # ROI range of sample points
-        self.dist_cf = 1
+        self.sp_rng = [1, self.num_samples]  # ROI range of sample points, 1-based
+        self.dist_cf = 1  # distance between two sample points in dist_unit, see get_dist_vector
+        self.binner = ChannelBinner()  # groups of sample points reduced after decoding, see set_binning
         self.zero_point = 0
 
         self.time_unit = 'time'
-        self.time_rng = None
-        self.shot_rng = [0, self.num_shots - 1]
-        self.utc_offset = None  # ROI range of shots
-
-        self.freq_rng = [20, math.floor(self.prf / 2)]  # analysis frequency bands
+        self.time_rng = None  # ROI as [start end] seconds since the Unix epoch, see set_time_rng
+        # ROI range of shots, 0-based, only the shots the file holds when
+        # the capture was cut short of EndShots
+        self.shot_rng = [0, min(self.num_shots, reader.get_num_shots()) - 1]
+        self.utc_offset = None  # hours from UTC of wall-clock times without a date, None for UTC
+        # time of shot 0 in seconds since the Unix epoch, 0 when the header doesn't have it
+        self.start_time = reader.header.get_start_time() or 0.0
+
+        self.freq_rng = [20, math.floor(self.prf / 2)]  # analysis frequency bands [start end start end ...]
         self.time_rng_view = [20, math.floor(self.prf / 2)]  # frequency bands to view
         self.output_path = None  # output path
 
         self.num_fft = 2048
+        self.spectral_engine = 'auto'  # 'fft', 'dft' (band-limited) or 'auto', see get_spectrum_layout
+        self.max_batch_bytes = 256 * 1024 * 1024  # memory cap of one spectrogram batch
 
         if "Acquisition.Optics.PulseRepetitionFrequency_Hz" in reader.header.values:
             self.prf = int(reader.header.values["Acquisition.Optics.PulseRepetitionFrequency_Hz"])
         else:
             self.prf = int(reader.header.values["acquisition.laserPulseRate"])
         self.fft_bin_size = float(self.prf) / self.num_fft
-        self.rolling_step = self.num_fft / 2  # 50% overlap
-        self.rolling_step_percent = (self.rolling_step / self.num_fft) * 100
-        self.rolling_sec = self.rolling_step / self.prf
+        self.rolling_step = self.num_fft // 2  # 50% overlap
+        self.rolling_step_percent = (float(self.rolling_step) / self.num_fft) * 100
+        self.rolling_sec = float(self.rolling_step) / self.prf
         self.frame_length = self.num_fft
 
         self.num_frames = \
-            int(math.floor((numpy.diff(self.shot_rng, n=1, axis=0)
-                            + 1 - self.frame_length) / self.rolling_step) + 1)
+            int(math.floor((self.shot_rng[1] - self.shot_rng[0]
+                            + 1 - self.frame_length) / float(self.rolling_step)) + 1)
 
         self.psd_stacking_factor = 1
+        self.psd_stack = None  # rolling PSD stack of process_chunk
         self.nf_adjustment = False
+        self.nf_estimator = NoiseFloorEstimator('median')  # see NoiseFloor for the methods
+        self.nf_freq_rng = None  # noise floor band in Hz, None for the upper quarter of the spectrum
 
         self.display_mode = 3
         self.dpsd_c_rng = [0, 0]
@@ -80,9 +160,12 @@ class SpectralAnalysis(object):
         self.psd_file = ''
 
         self.processor = 'N-CPU'  # 'CPU', 'GPU', 'N-CPU'
+        self.num_workers = None  # processes used by 'N-CPU', None for all CPUs
+        self.num_threads = None  # threads per batch, None to choose from the batch size
+        self.profiler = reader.profiler  # times the stages when enabled, shared with the reader
         self.sf = []    # sound field data
         self.freq_vector = None
-        self.dist_vector = [0, 0]  # get_dist_vector()
+        self.dist_vector = [0, 0]  # distance of every sound field channel, see get_dist_vector
         self.time_vector = []
 
         # private properties
@@ -99,35 +182,32 @@ class SpectralAnalysis(object):
         self.frame_shot_rng = None
         self.bin_rng = None
         self.v_bin_rng = None
+        self.layout = None  # cached by get_spectrum_layout
+        self.sf_band = -1  # index of the band used for the sound field
 
-        self.freq_vector = self.prf / 2 * numpy.linspace(0, 1, self.num_fft / 2 + 1)
-
-        def my_func(x):
-            v1 = round(self.freq_rng[0] / self.fft_bin_size) + 1
-            v2 = round(self.freq_rng[1] / self.fft_bin_size) + 1
-            return [v1, v2]
+        self.freq_vector = self.prf / 2 * numpy.linspace(0, 1, self.num_fft // 2 + 1)
 
-        self.bin_rng = map(my_func, range(1, len(self.freq_rng)))
-        self.bin_rng = self.bin_rng[0]
+        self.bin_rng = self.get_bin_rng(self.freq_rng)
 
         self.v_bin_rng = [round(self.time_rng_view[0] / self.fft_bin_size) + 1,
                           round(self.time_rng_view[1] / self.fft_bin_size) + 1]
 
-        self.num_samples = int(numpy.diff(self.sp_rng, n=1, axis=0) + 1)
+        self.num_samples = self.binner.get_num_bins(self.sp_rng[1] - self.sp_rng[0] + 1)
 
         self.num_shots = numpy.diff(self.shot_rng) + 2
 
-        self.time_vector = self.get_time_vector()  # TODO: Fix this method but only used for display
+        self.time_vector = self.get_time_vector()
+        self.dist_vector = self.get_dist_vector()
 
-        self.time_vector = numpy.empty(545)
-        self.time_vector.fill(735670)
-
-        # TODO: remove hard-coded values here.  This is only used for display
-        self.dist_vector = [.9200, 3.4872, 4.0544, 4.6216, 5.1888,
-                            5.7560, 6.3232, 6.8904, 7.4576, 8.0248,
-                            8.5920, 9.1592, 9.7264, 10.2935, 10.8607,
-                            11.4279, 11.9951, 12.5623, 13.1295, 13.6967,
-                            14.2639, 14.8311, 15.3983, 15.9655, 16.5327]
+    def __getstate__(self):
+        # results and plot handles stay in this process,
+        # worker processes only need the settings
+        state = self.__dict__.copy()
+        for name in ['sf', 'fft', 'psd', 'apsd', 'snr', 'noise_floor', 'psd_stack']:
+            state[name] = None
+        for name in ['fig', 'psd_plot', 'psd_image_handle', 'snr_plot', 'sf_image_handle']:
+            state[name] = []
+        return state
 
     @staticmethod
     def print_output(title='', value=''):
@@ -136,41 +216,98 @@ class SpectralAnalysis(object):
     @staticmethod
     def get_data_type_byte_size(encoding):
         """
-        Get the machine dependent size of the data type used
+        Get the size of the data type used
         in the FDS data file
         :param encoding: The data type to find the size for
         :return: The number of bytes for the data type
         """
-        if encoding in ['float32' 'real32' 'single']:
-            data_byte = numpy.dtype(int).itemsize
+        return get_data_type(encoding).itemsize
 
-        elif encoding in ['real64' 'double']:
-            data_byte = numpy.dtype(float).itemsize
+    def get_time_vector(self):
+        """
+        Time axis of the sound field, the time of the first shot of each
+        row's PSD stack.  The last row stacks the psd_stacking_factor
+        frames before the last frame, see get_row_shots
+        :return: (rows,) seconds since the Unix epoch
+        """
+        num_rows = self.get_num_rows(self.num_frames)
+        frames = numpy.minimum(numpy.arange(num_rows) * self.psd_stacking_factor,
+                               max(self.num_frames - self.psd_stacking_factor, 0))
 
-        elif encoding in ['uint16']:
-            data_byte = numpy.dtype(numpy.uint16).itemsize
+        return self.get_shot_times(self.shot_rng[0] + frames * int(self.rolling_step))
 
-        else:
-            data_byte = 4  # default
+    def get_shot_times(self, shots):
+        """
+        Time of shots, from TimeOfFirstSample and the PRF
+        :param shots: Shot or array of shots, 0-based from the start of the file
+        :return: seconds since the Unix epoch, shaped like shots
+        """
+        return self.start_time + numpy.asarray(shots, dtype=numpy.float64) / self.prf
 
-        return data_byte
+    def get_shots_at(self, times):
+        """
+        Last shot at or before each time, the inverse of get_shot_times
+        :param times: Time or array of times, seconds since the Unix epoch
+        :return: int64 shots, shaped like times, not limited to the file
+        """
+        return numpy.floor(self.get_shot_positions(times) + self.SHOT_TOLERANCE).astype(numpy.int64)
 
-    def get_time_vector(self):
+    def get_shot_positions(self, times):
         """
-        Return a vector of time periods to divide the data
-        :return:
+        :param times: Time or array of times, seconds since the Unix epoch
+        :return: fractional shot index of each time, float64
+        """
+        return (numpy.asarray(times, dtype=numpy.float64) - self.start_time) * self.prf
+
+    def get_time(self, value):
+        """
+        Seconds since the Unix epoch of a time given as a number, a full
+        timestamp ('yyyy-mm-ddTHH:MM:SS.FFFFFFF') or a wall-clock time
+        ('HH:MM:SS.FFF') on the day of the first shot in utc_offset hours
+        :param value: float, int or str
+        :return: float
+        """
+        if isinstance(value, (int, float, numpy.number)):
+            return float(value)
+
+        time = parse_timestamp(value)
+        if time is not None:
+            return time
+
+        offset = (self.utc_offset or 0) * 3600.0
+        day = math.floor((self.start_time + offset) / 86400.0) * 86400.0 - offset
+
+        return day + self.time_string_to_sec(value, 1)
+
+    def set_time_rng(self, start, end):
+        """
+        Limit the ROI to the shots recorded in a time window, e.g.
+        set_time_rng('14:02:10', '14:05:00').  The shots are computed
+        from the header, the data is not scanned, and a window that ends
+        before it starts is taken to cross midnight
+        :param start: Start of the window, anything get_time accepts
+        :param end: End of the window, inclusive
+        :return: [first last] shots of the window
         """
-        sec_rng = numpy.subtract(self.shot_rng, 1) / self.prf
-        step_s = self.rolling_sec * self.psd_stacking_factor
-        vector = range(sec_rng[0], step_s, sec_rng[1])
+        start = self.get_time(start)
+        end = self.get_time(end)
+        if end < start:
+            end += 86400
 
-        first_shot = self.reader.header.values["TimeOfFirstSample"]
-        time_no = self.time_string_to_sec(first_shot, 1)
+        # the first shot at or after start, the last at or before end
+        first = int(numpy.ceil(self.get_shot_positions(start) - self.SHOT_TOLERANCE))
+        last = int(self.get_shots_at(end))
 
-        # time_no = datenum(ref_time.Year,ref_time.Month,ref_time.Day,0,0,ref_seconds);
-        vector = numpy.multiply(vector, (1 / (3600 * 24))) + time_no
+        first = max(first, 0)
+        last = min(last, self.reader.get_num_shots() - 1)
+        if first > last:
+            raise Exception("SpectralAnalysis:EmptyTimeRange\n"
+                            "No shots recorded between {0} and {1}".format(start, end))
 
-        return vector
+        self.time_rng = [start, end]
+        self.set_roi(shot_rng=[first, last])
+
+        return self.shot_rng
 
     def time_string_to_sec(self, time_string, format=1):
         """timestr2sec
@@ -195,90 +332,730 @@ class SpectralAnalysis(object):
                          6 - 'mmddyyyy'
 
         """
-        if format == 1:
-            # 'HH:MM:SS.FFFFFFF', 'HH.MM.SS.FFFFFFF'
-            index = time_string.find(':')
-            substring = time_string[index + 1:-2]
+        if format in (1, 2):
+            # 'HH:MM:SS.FFFFFFF', 'HH.MM.SS.FFFFFFF', seconds since midnight.
+            # the time of day of a full timestamp is found as well
+            m = re.search(r'(\d{1,2})[:.](\d{2})(?:[:.](\d{2})(\.\d+)?)?\s*Z?\s*$', time_string)
+            if m is None:
+                raise Exception("SpectralAnalysis:InvalidTime\nNot a time of day: {0}".format(time_string))
+
+            seconds = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3) or 0) + float(m.group(4) or 0)
+        elif format == 3:
+            # 'yyyy-mm-ddTHH:MM:SS.FFFFFFF', seconds since the Unix epoch
+            seconds = parse_timestamp(time_string)
+            if seconds is None:
+                raise Exception("SpectralAnalysis:InvalidTime\nNot a timestamp: {0}".format(time_string))
+        else:
+            raise Exception("SpectralAnalysis:UnsupportedTimeFormat\nTime format {0} isn't supported".format(format))
 
-            # use regex to split the time
-            segments = re.split(r'\s+|[:.]\s*', substring)
+        return seconds
 
-            hours = int(segments[0])
-            minutes = int(segments[1])
-            millisecs = float(segments[2]) / 1000000
+    def set_precision(self, precision):
+        """
+        Choose the floating point precision of the whole analysis.
+        'single' keeps the frames, spectra, PSD, noise floor and SNR in
+        float32 / complex64, which halves memory traffic and is plenty
+        for 16-bit data.  The spectra need numpy 2.0 or scipy to stay
+        complex64, see get_rfft_dtype
+        :param precision: 'double' or 'single'
+        :return:
+        """
+        if precision not in ['double', 'single']:
+            raise Exception("SpectralAnalysis:UnknownPrecision\n"
+                            "Precision must be 'double' or 'single', not '{0}'".format(precision))
 
-            seconds = float((hours * 60 * 60) + (minutes * 60)) + millisecs
+        self.precision = precision
+        self.decoder = DataDecoder(self.encoding, self.daq_card_range, dtype=self.get_dtype())
 
-        return seconds
+    def set_num_fft(self, num_fft, rolling_step=None):
+        """
+        Change the frame length and everything derived from it
+        :param num_fft: Shots per frame
+        :param rolling_step: Shots between frames, defaults to num_fft / 2
+        :return:
+        """
+        self.num_fft = int(num_fft)
+        self.frame_length = self.num_fft
+        self.fft_bin_size = float(self.prf) / self.num_fft
+        self.rolling_step = int(rolling_step or self.num_fft // 2)
+        self.rolling_step_percent = (float(self.rolling_step) / self.num_fft) * 100
+        self.rolling_sec = float(self.rolling_step) / self.prf
 
-    def process_chunk(self, iteration, chunk):
+        self.freq_vector = self.prf / 2 * numpy.linspace(0, 1, self.num_fft // 2 + 1)
+        self.bin_rng = self.get_bin_rng(self.freq_rng)
+        self.v_bin_rng = [round(self.time_rng_view[0] / self.fft_bin_size) + 1,
+                          round(self.time_rng_view[1] / self.fft_bin_size) + 1]
+
+        self.set_roi()
+
+    def set_binning(self, size=1, stride=None, method='mean'):
         """
-        Perform fft analysis on a data chunk
+        Reduce groups of neighbouring sample points to one sound field
+        channel right after decoding, see ChannelBinner.  The FFT, noise
+        floor and SNR then run on size / stride times fewer channels
+        :param size: Sample points in a group, 1 for no binning
+        :param stride: Sample points from one group to the next, defaults to size
+        :param method: 'mean' or 'rms'
         :return:
         """
-        # loop through all frames and run fft on each frame
-        frame = iteration - 1
+        self.binner = ChannelBinner(size, stride, method)
 
-        # calculate the current shot range in this frame
-        t = self.shot_rng[0] + (frame - 1) * self.rolling_step
-        self.frame_shot_rng = [t + 1, t + self.frame_length]
+        if self.binner.get_num_bins(self.sp_rng[1] - self.sp_rng[0] + 1) == 0:
+            raise Exception("SpectralAnalysis:InvalidBinning\n"
+                            "The ROI has fewer sample points than a group of {0}".format(self.binner.size))
 
-        # read data
-        if frame == 1:
-            rows = numpy.shape(chunk)[0]
-            buffer_shot_rng = [self.frame_shot_rng[0], self.frame_shot_rng[0] + rows - 1]  # TODO remove hardcode
+        self.set_roi()
 
-        # generate Raw PSD
-        fft = numpy.fft.fft(chunk, self.num_fft, axis=0)
+    def get_dist_vector(self):
+        """
+        Distance along the fiber of every sound field channel, the middle
+        of its group of sample points when they are binned
+        :return: (num_samples,) distances in dist_unit
+        """
+        centers = self.binner.get_centers(self.sp_rng[1] - self.sp_rng[0] + 1)
 
-        psd = abs(fft[0:self.num_fft / 2 + 1, :]) ** 2 / self.frame_length
+        return self.position_first_sample + self.dist_cf * (self.sp_rng[0] - 1 + centers)
 
-        psd[1:-1] = 2 * psd[1:-1]  # ignore DC (0Hz) and Nyquist
+    def set_freq_rng(self, freq_rng):
+        """
+        Change the analysis frequency bands
+        :param freq_rng: [start end start end ...] in Hz
+        :return:
+        """
+        self.freq_rng = list(freq_rng)
+        self.bin_rng = self.get_bin_rng(self.freq_rng)
 
-        # stacking psd
-        if self.psd_stacking_factor == 1:
-            apsd = psd
+    def get_dtype(self):
+        """
+        :return: numpy float type of the selected precision
+        """
+        return numpy.dtype(numpy.float32 if self.precision == 'single' else numpy.float64)
 
-        # estimate noise floor level
-        if frame % self.psd_stacking_factor == 0 or frame == self.num_frames:
-            self.noise_floor = numpy.median(apsd[(-self.num_fft / 4):-2,:], axis=0)
+    def get_bin_rng(self, freq_rng):
+        """
+        Convert frequency bands to FFT bins
+        :param freq_rng: Flat list of band edges in Hz [start end start end ...]
+        :return: list of [start end] bins, one per band, 1-based like MATLAB
+        """
+        return [[int(round(freq_rng[i] / self.fft_bin_size)) + 1,
+                 int(round(freq_rng[i + 1] / self.fft_bin_size)) + 1]
+                for i in range(0, len(freq_rng) - 1, 2)]
+
+    def get_nf_bins(self):
+        """
+        FFT bins the noise floor is estimated from, nf_freq_rng or else
+        the upper quarter of the spectrum below the last two bins
+        :return: slice over the FFT bins
+        """
+        num_bins = self.num_fft // 2 + 1
+
+        if self.nf_freq_rng is None:
+            return slice(num_bins - self.num_fft // 4, num_bins - 2)
 
-            self.noise_floor[self.noise_floor <= 0] = 1e-6
+        return slice(int(round(self.nf_freq_rng[0] / self.fft_bin_size)),
+                     min(int(round(self.nf_freq_rng[1] / self.fft_bin_size)) + 1, num_bins))
 
-            # calculate SNR
-            for i in xrange(0, len(self.freq_rng) / 2):
+    def get_spectrum_layout(self):
+        """
+        Decide which FFT bins get_psd computes and where the analysis bands
+        and the noise region are in its rows.  The full FFT is replaced by
+        a band-limited DFT of only the bins in use when spectral_engine is
+        'dft', or when it is 'auto' and those bins are few enough that the
+        DFT is cheaper (fewer than DFT_BINS_PER_LOG2 * log2(num_fft))
+        :return: dict with 'bins' (None for every bin, else the sorted bins
+                 of the PSD rows), 'nf_rows', 'span' (slices over the PSD
+                 rows), 'indices' (reduceat indices of the bands into the
+                 span), 'not_empty' (mask of the bands with any bins)
+                 and 'view_rows' (slice of the displayed range, complete
+                 only when b_save_psd is set)
+        """
+        num_bins = self.num_fft // 2 + 1
+        nf_bins = self.get_nf_bins()
+        key = [self.num_fft, [list(rng) for rng in self.bin_rng], [nf_bins.start, nf_bins.stop],
+               self.spectral_engine, self.b_save_psd and list(self.v_bin_rng), self.precision]
+
+        if self.layout is not None and self.layout['key'] == key:
+            return self.layout
+
+        # bin_rng is in the form [x y] where x is the start and y is the end
+        # subtract one because python is zero indexed, unlike MATLAB
+        starts = numpy.clip([rng[0] - 1 for rng in self.bin_rng], 0, num_bins)
+        ends = numpy.clip([rng[1] for rng in self.bin_rng], 0, num_bins)
+
+        # the bins of the bands and the noise region, and of the
+        # displayed range when the PSD is saved
+        view_bins = slice(max(int(self.v_bin_rng[0]) - 1, 0), min(int(self.v_bin_rng[1]), num_bins))
+        used = [numpy.arange(start, end) for start, end in zip(starts, ends)]
+        used.append(numpy.arange(nf_bins.start, nf_bins.stop))
+        if self.b_save_psd:
+            used.append(numpy.arange(view_bins.start, view_bins.stop))
+        bins = numpy.unique(numpy.concatenate(used)).astype(int)
+
+        if self.spectral_engine == 'fft' or \
+                (self.spectral_engine == 'auto' and
+                 len(bins) >= self.DFT_BINS_PER_LOG2 * math.log(self.num_fft, 2)):
+            bins = None
+            rows = numpy.arange(num_bins)
+        else:
+            rows = bins
+
+        # from FFT bins to PSD rows
+        starts = numpy.searchsorted(rows, starts)
+        ends = numpy.searchsorted(rows, ends)
+        span = slice(int(starts.min()), int(ends.max()))
+
+        self.layout = {
+            'key': key,
+            'bins': bins,
+            'nf_rows': slice(int(numpy.searchsorted(rows, nf_bins.start)),
+                             int(numpy.searchsorted(rows, nf_bins.stop))),
+            'span': span,
+            # [start end start end ...], reduceat sums each start:end pair
+            'indices': numpy.column_stack((starts, ends)).ravel() - span.start,
+            'not_empty': starts < ends,
+            'view_rows': slice(int(numpy.searchsorted(rows, view_bins.start)),
+                               int(numpy.searchsorted(rows, view_bins.stop))),
+        }
+
+        if bins is not None:
+            # cos and sin of the DFT of the selected bins, the product k * n
+            # is reduced modulo num_fft first to keep the angles exact
+            phase = numpy.outer(bins, numpy.arange(self.num_fft)) % self.num_fft
+            phase = phase * (2 * numpy.pi / self.num_fft)
+            self.layout['dft'] = (numpy.cos(phase).astype(self.get_dtype()),
+                                  numpy.sin(phase).astype(self.get_dtype()))
+
+        return self.layout
+
+    def get_spectrum(self, frames):
+        """
+        FFT of one or more frames, complex64 in single precision where
+        a single precision FFT is available, see get_rfft_dtype
+        :param frames: (..., num_fft, channels) array of shots
+        :return: (..., num_fft / 2 + 1, channels) spectrum
+        """
+        return rfft(numpy.asarray(frames, dtype=self.get_dtype()), self.num_fft, axis=-2)
+
+    def get_psd(self, frames):
+        """
+        One-sided power spectral density of one or more frames
+        :param frames: (..., num_fft, channels) array of shots
+        :return: (..., rows, channels) PSD of the bins in
+                 get_spectrum_layout, all num_fft / 2 + 1 of them
+                 unless the band-limited DFT is used
+        """
+        layout = self.get_spectrum_layout()
+        dtype = self.get_dtype()
+
+        if layout['bins'] is None:
+            fft = self.get_spectrum(frames)
 
-                # make an array of logically false values
-                b_mask = numpy.zeros(apsd.shape).astype(int)
+            psd = numpy.square(fft.real, dtype=dtype)
+            psd += numpy.square(fft.imag, dtype=dtype)
+            psd /= self.frame_length
 
-                # bin_rng is in the form [x y] where x is the start and y is the end
-                # subtract one because python is zero indexed, unlike MATLAB
-                bin_rng_start = self.bin_rng[i] - 1
-                # add one because python's ending value is excluded, unlike MATLAB
-                bin_rng_end = self.bin_rng[i + 1] + 1
+            psd[..., 1:-1, :] *= 2  # ignore DC (0Hz) and Nyquist
 
-                apsd_compare = apsd[bin_rng_start: bin_rng_end]
-                replicated = numpy.tile(self.noise_floor, [int(numpy.diff(self.bin_rng)) + 1, 1])
+            return psd
 
-                b_mask[bin_rng_start: bin_rng_end] = (apsd_compare > replicated)
+        cos, sin = layout['dft']
+        frames = numpy.asarray(frames, dtype=dtype)
 
-                signal_est = sum(apsd[bin_rng_start: bin_rng_end] *
-                                 b_mask[bin_rng_start: bin_rng_end], 0)
+        psd = numpy.square(numpy.matmul(cos, frames))
+        psd += numpy.square(numpy.matmul(sin, frames))
+        psd /= self.frame_length
 
-                not_b_mask = numpy.logical_not(b_mask[bin_rng_start: bin_rng_end])
-                noise_est = sum(apsd_compare * not_b_mask, 0)
+        # ignore DC (0Hz) and Nyquist
+        bins = layout['bins']
+        psd[..., numpy.logical_and(bins != 0, bins != self.num_fft // 2), :] *= 2
 
-                with numpy.errstate(divide='ignore'):
-                    self.snr = numpy.divide(signal_est, noise_est)
+        return psd
+
+    def get_noise_floor(self, apsd):
+        """
+        Estimate the noise floor of every channel from the noise
+        region of the spectrum, see get_nf_bins
+        :param apsd: (..., rows, channels) PSD from get_psd
+        :return: (..., channels) noise floor
+        """
+        noise_floor = self.nf_estimator.estimate(apsd[..., self.get_spectrum_layout()['nf_rows'], :])
 
-                self.snr[signal_est == 0] = 0
-                self.snr[noise_est == 0] = 0
+        noise_floor[noise_floor <= 0] = 1e-6
 
-                # reset and insert the value at the beginning of the array
-                self.sf = []
-                self.sf = numpy.insert(self.sf, 0, self.snr, 0)
+        return noise_floor
+
+    def get_snr(self, apsd, noise_floor):
+        """
+        Ratio of the power above the noise floor to the power below it
+        in every analysis band.  All bands are summed in one reduceat
+        pass over the rows they cover
+        :param apsd: (..., rows, channels) PSD from get_psd
+        :param noise_floor: (..., channels) noise floor
+        :return: (..., bands, channels) SNR, zero where either part is empty
+        """
+        layout = self.get_spectrum_layout()
+        span, indices, not_empty = layout['span'], layout['indices'], layout['not_empty']
+
+        apsd_compare = apsd[..., span, :]
+        b_mask = apsd_compare > noise_floor[..., numpy.newaxis, :]
+
+        # split the span into the power above and below the noise floor,
+        # with a trailing row of zeros so a band may end on the last row
+        shape = apsd_compare.shape[:-2] + (apsd_compare.shape[-2] + 1, apsd_compare.shape[-1])
+        signal = numpy.zeros(shape, dtype=apsd.dtype)
+        noise = numpy.zeros(shape, dtype=apsd.dtype)
+        numpy.copyto(signal[..., :-1, :], apsd_compare, where=b_mask)
+        numpy.copyto(noise[..., :-1, :], apsd_compare, where=~b_mask)
+
+        not_empty = not_empty[:, numpy.newaxis]
+        signal_est = numpy.add.reduceat(signal, indices, axis=-2)[..., ::2, :] * not_empty
+        noise_est = numpy.add.reduceat(noise, indices, axis=-2)[..., ::2, :] * not_empty
+
+        snr = numpy.zeros_like(signal_est)
+        numpy.divide(signal_est, noise_est, out=snr,
+                     where=numpy.logical_and(signal_est != 0, noise_est != 0))
+
+        return snr
+
+    def stack_psd(self, psd):
+        """
+        Sum the PSDs of every psd_stacking_factor consecutive frames.
+        Fewer frames than the factor are summed into a single stack
+        :param psd: (frames x bins x channels) PSD
+        :return: (stacks x bins x channels) stacked PSD
+        """
+        size = min(self.psd_stacking_factor, psd.shape[0])
+
+        return psd.reshape((-1, size) + psd.shape[1:]).sum(axis=1)
+
+    def get_num_frames(self, num_shots):
+        """
+        Number of complete frames in a block of shots
+        :param num_shots: Number of shots
+        :return: int
+        """
+        return max((int(num_shots) - self.num_fft) // int(self.rolling_step) + 1, 0)
+
+    def get_num_rows(self, num_frames):
+        """
+        Number of sound field rows computed from num_frames frames, one at
+        the end of every PSD stack and one for the last frame
+        :param num_frames: Number of frames
+        :return: int
+        """
+        return int(math.ceil(num_frames / float(self.psd_stacking_factor)))
+
+    def get_row_shots(self, first, last, num_frames):
+        """
+        Shots needed to compute the sound field rows [first, last).  The
+        last row stacks the psd_stacking_factor frames before the last
+        frame, which may reach back into the previous row
+        :param first: First row
+        :param last: Row after the last one
+        :param num_frames: Number of frames in the whole block
+        :return: (start, stop) shot indices relative to the block
+        """
+        stacking = self.psd_stacking_factor
+        first_frame = min(first * stacking, max(num_frames - stacking, 0))
+        last_frame = min(last * stacking, num_frames)
+
+        return (first_frame * int(self.rolling_step),
+                (last_frame - 1) * int(self.rolling_step) + self.num_fft)
+
+    def get_frames_per_batch(self, num_channels):
+        """
+        Number of frames that fit in max_batch_bytes, counting the float
+        copy of the frames, the complex spectrum and the PSD arrays.
+        Always a whole number of PSD stacks
+        :param num_channels: Number of channels in a frame
+        :return: int, at least psd_stacking_factor
+        """
+        num_stacks = max(int(self.max_batch_bytes // (self.get_frame_bytes(num_channels) *
+                                                      self.psd_stacking_factor)), 1)
+
+        return num_stacks * self.psd_stacking_factor
+
+    def get_frame_bytes(self, num_channels):
+        """
+        Memory one frame takes while a batch is analyzed
+        :param num_channels: Number of channels in a frame, before binning
+        :return: int
+        """
+        num_bins = self.num_fft // 2 + 1
+        num_out = self.binner.get_num_bins(num_channels)
+        itemsize = self.get_dtype().itemsize
+        spectrum_itemsize = get_rfft_dtype(self.get_dtype()).itemsize
+
+        frame_bytes = (num_channels * self.num_fft + num_out * num_bins * 2) * itemsize + \
+            num_out * num_bins * spectrum_itemsize
+        if self.binner.enabled:
+            frame_bytes += num_out * self.num_fft * itemsize
+        if spectrum_itemsize > 2 * itemsize:
+            # the FFT computes in double, on a float64 copy of the frames
+            frame_bytes += num_out * self.num_fft * numpy.dtype(numpy.float64).itemsize
+        elif self.get_dtype() == numpy.float32 and not NUMPY_SINGLE_FFT:
+            # the packed output of scipy.fftpack before it is unpacked
+            frame_bytes += num_out * self.num_fft * itemsize
+
+        return frame_bytes
+
+    def get_num_threads(self, num_frames, num_channels):
+        """
+        Number of threads to split the channels of a batch over.  Uses
+        num_threads when it is set, otherwise gives every thread at least
+        MIN_THREAD_SAMPLES samples and MIN_THREAD_CHANNELS channels
+        :param num_frames: Number of frames in a batch
+        :param num_channels: Number of channels in a frame
+        :return: int, at least 1
+        """
+        if self.num_threads:
+            return max(min(int(self.num_threads), num_channels), 1)
+
+        by_size = num_frames * self.num_fft * num_channels // self.MIN_THREAD_SAMPLES
+        by_channels = num_channels // self.MIN_THREAD_CHANNELS
+
+        return max(min(multiprocessing.cpu_count(), by_size, by_channels), 1)
+
+    def process_shots(self, shots, out, buffer=None, psd_out=None):
+        """
+        Decode and bin a block of shots and compute the PSD, noise floor
+        and SNR of all of its frames
+        :param shots: (shots x channels) raw samples whose frames are a
+                      whole number of PSD stacks or a single partial one,
+                      the channels of whole groups of the binner
+        :param out: (stacks x channels) array for the SNR of sf_band, or
+                    (stacks x bands x channels) for the SNR of every band
+        :param buffer: Optional array to decode into, at least as many
+                       shots long as shots
+        :param psd_out: Optional (stacks x bins x channels) array for the
+                        stacked PSD of the displayed range
+        :return:
+        """
+        profiler = self.profiler
+
+        if buffer is not None:
+            buffer = buffer[:shots.shape[0]]
+        with profiler.stage('decode', shots=shots.shape[0], bytes=shots.nbytes):
+            volts = self.decoder.decode(shots, out=buffer)
+
+        if self.binner.enabled:
+            with profiler.stage('bin', shots=shots.shape[0]):
+                volts = self.binner.bin(volts)
+
+        frames = ReadFDS.frame_view(volts, self.num_fft, self.rolling_step)
+        with profiler.stage('fft', frames=frames.shape[0]):
+            apsd = self.get_psd(frames)
+
+        if self.psd_stacking_factor > 1:
+            with profiler.stage('stack'):
+                apsd = self.stack_psd(apsd)
+
+        with profiler.stage('noise_floor'):
+            noise_floor = self.get_noise_floor(apsd)
+        with profiler.stage('snr'):
+            snr = self.get_snr(apsd, noise_floor)
+
+        with profiler.stage('sink', bytes=out.nbytes + (0 if psd_out is None else psd_out.nbytes)):
+            if psd_out is not None:
+                psd_out[...] = apsd[:, self.get_spectrum_layout()['view_rows']]
+
+            if out.ndim == 3:
+                out[...] = snr
+            else:
+                out[...] = snr[:, self.sf_band]
+
+    def spectrogram(self, block, out=None, all_bands=False, psd_out=None, reset=True):
+        """
+        Run the analysis on every complete frame in a block of shots at
+        once.  The shots of a batch are decoded into one buffer, its
+        frames are strided views of it, and batches take at most
+        max_batch_bytes
+        :param block: (shots x channels) raw samples, e.g. get_roi_data()
+        :param out: Optional array to write the rows to, shaped like the
+                    result, with a channel per group of the binner
+        :param all_bands: Return the SNR of every band instead of sf_band
+        :param psd_out: Optional (rows x bins x channels) array for the
+                        PSD of the displayed range, see get_view_psd
+        :param reset: Restart a running noise floor estimate, False to
+                      go on from the block before, which must end
+                      where this block starts
+        :return: (rows x channels) SNR of sf_band, or (rows x bands x
+                 channels) with all_bands, one sound field row per PSD
+                 stack plus one for the last frame, see get_num_rows
+        """
+        step = int(self.rolling_step)
+        num_frames = self.get_num_frames(block.shape[0])
+        num_channels = self.binner.get_num_bins(block.shape[1])
+        num_rows = self.get_num_rows(num_frames)
+        batch = self.get_frames_per_batch(block.shape[1])
+
+        if out is None:
+            if all_bands:
+                out = numpy.zeros((num_rows, len(self.bin_rng), num_channels), dtype=self.get_dtype())
+            else:
+                out = numpy.zeros((num_rows, num_channels), dtype=self.get_dtype())
+        self.sf = out
+
+        # whole stacks go through in batches, the last frame closes
+        # a stack of the psd_stacking_factor frames before it
+        frame_rngs = []
+        num_whole = num_frames - num_frames % self.psd_stacking_factor
+        for start in range(0, num_whole, batch):
+            stop = min(start + batch, num_whole)
+            rows = slice(start // self.psd_stacking_factor, stop // self.psd_stacking_factor)
+            frame_rngs.append((start, stop, rows))
+        if num_whole < num_frames:
+            frame_rngs.append((max(num_frames - self.psd_stacking_factor, 0), num_frames,
+                               slice(num_rows - 1, num_rows)))
+
+        # channels are independent, so each thread takes a range of them,
+        # unless the noise floor estimate carries over between frames.
+        # A thread reads the sample points of the groups of its channels
+        if reset:
+            self.nf_estimator.reset()
+        if self.nf_estimator.stateful:
+            num_threads = 1
+        else:
+            num_threads = self.get_num_threads(min(batch, num_frames), num_channels)
+        channel_rngs = ParallelProcessor.get_shards(num_channels, num_threads)
+        sample_rngs = [self.binner.get_channel_rng(first, last) for first, last in channel_rngs]
+        pool = ThreadPool(len(channel_rngs)) if len(channel_rngs) > 1 else None
+
+        # one decode buffer per thread, reused by every batch
+        max_shots = (min(batch, num_frames) - 1) * step + self.num_fft
+        buffers = [numpy.empty((max(max_shots, 0), last - first), dtype=self.decoder.dtype)
+                   for first, last in sample_rngs]
+        self.profiler.set_buffer('decode', sum(buf.nbytes for buf in buffers))
+        self.profiler.set_buffer('batch', min(batch, num_frames) * self.get_frame_bytes(num_channels))
+
+        try:
+            for start, stop, rows in frame_rngs:
+                shots = block[start * step:(stop - 1) * step + self.num_fft]
+                batch_out = out[rows]
+                batch_psd = None if psd_out is None else psd_out[rows]
+
+                if pool is None:
+                    self.process_shots(shots[:, sample_rngs[0][0]:sample_rngs[0][1]], batch_out, buffers[0],
+                                       batch_psd)
+                else:
+                    pool.map(lambda i: self.process_shots(shots[:, sample_rngs[i][0]:sample_rngs[i][1]],
+                                                          batch_out[..., channel_rngs[i][0]:channel_rngs[i][1]],
+                                                          buffers[i],
+                                                          None if batch_psd is None else
+                                                          batch_psd[..., channel_rngs[i][0]:channel_rngs[i][1]]),
+                             range(len(channel_rngs)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.profiler.set_buffer('decode', 0)
+            self.profiler.set_buffer('batch', 0)
+
+        if num_rows:
+            self.snr = self.sf[-1]
+
+        return self.sf
+
+    def set_roi(self, shot_rng=None, sp_rng=None):
+        """
+        Change the region of interest and the values derived from it
+        :param shot_rng: [first last] shots, 0-based and inclusive
+        :param sp_rng: [first last] channels, 1-based and inclusive
+        :return:
+        """
+        if shot_rng is not None:
+            self.shot_rng = [int(shot_rng[0]), int(shot_rng[1])]
+        # a short file doesn't hold every shot of the header
+        self.shot_rng[1] = min(self.shot_rng[1], self.reader.get_num_shots() - 1)
+        if sp_rng is not None:
+            self.sp_rng = [int(sp_rng[0]), int(sp_rng[1])]
+
+        self.num_samples = self.binner.get_num_bins(self.sp_rng[1] - self.sp_rng[0] + 1)
+        self.num_frames = max(int(math.floor((self.shot_rng[1] - self.shot_rng[0] + 1 - self.frame_length) /
+                                             float(self.rolling_step))) + 1, 0)
+        self.time_vector = self.get_time_vector()
+        self.dist_vector = self.get_dist_vector()
+
+    def get_channel_slice(self):
+        """
+        Channels of the ROI, sp_rng is 1-based and inclusive like MATLAB
+        :return: slice over the channels
+        """
+        return slice(int(self.sp_rng[0]) - 1, int(self.sp_rng[1]))
+
+    def get_roi_data(self):
+        """
+        The shots of shot_rng and channels of sp_rng as a strided view over
+        the memory-mapped file.  Only the pages holding the ROI are read
+        :return: (shots x channels) array
+        """
+        if self.reader.mat is None:
+            self.reader.map_data()
+
+        return self.reader.mat[int(self.shot_rng[0]):int(self.shot_rng[1]) + 1, self.get_channel_slice()]
+
+    def get_view_psd(self, apsd=None):
+        """
+        The displayed range (v_bin_rng) of a PSD, as saved with b_save_psd
+        :param apsd: (..., rows, channels) PSD from get_psd, defaults to
+                     the last stacked PSD of process_chunk
+        :return: (..., bins, channels) view
+        """
+        if apsd is None:
+            apsd = self.apsd
+
+        return apsd[..., self.get_spectrum_layout()['view_rows'], :]
+
+    def get_num_view_bins(self):
+        """
+        :return: number of bins get_view_psd returns
+        """
+        view_rows = self.get_spectrum_layout()['view_rows']
+
+        return view_rows.stop - view_rows.start
+
+    def get_result_params(self):
+        """
+        Everything the sound field of the current settings depends on,
+        to tell whether results saved earlier are still valid
+        :return: JSON-serializable dict
+        """
+        nf_bins = self.get_nf_bins()
+
+        return {
+            'file': os.path.abspath(self.reader.file_in),
+            'file_size': int(self.reader.header.file_size),
+            'file_mtime': os.stat(self.reader.file_in).st_mtime,
+            'shot_rng': [int(x) for x in self.shot_rng],
+            'sp_rng': [int(x) for x in self.sp_rng],
+            'num_fft': int(self.num_fft),
+            'rolling_step': int(self.rolling_step),
+            'psd_stacking_factor': int(self.psd_stacking_factor),
+            'bin_rng': [[int(x) for x in rng] for rng in self.bin_rng],
+            'sf_band': int(self.sf_band),
+            'nf_bins': [nf_bins.start, nf_bins.stop],
+            'nf_estimator': [self.nf_estimator.method, self.nf_estimator.smoothing, self.nf_estimator.subsample],
+            'spectral_engine': self.spectral_engine,
+            'precision': self.precision,
+            'view_bins': self.b_save_psd and [int(x) for x in self.v_bin_rng],
+            'binning': [self.binner.size, self.binner.stride, self.binner.method],
+        }
+
+    def compute_sound_field(self, store=None):
+        """
+        Compute the sound field of shot_rng on the selected processor
+        :param store: Optional ResultSink.ResultStore to write the rows
+                      to.  Rows it already holds are not computed again,
+                      the rest are checkpointed as they complete
+        :return: (rows x channels) SNR, one row per PSD stack
+        """
+        if self.processor == 'N-CPU':
+            return ParallelProcessor.spectrogram(self, self.num_workers, store)
+        elif self.processor == 'CPU':
+            data = self.get_roi_data()
+            if store is None:
+                return self.spectrogram(data)
+
+            num_frames = self.get_num_frames(data.shape[0])
+            num_rows = self.get_num_rows(num_frames)
+
+            # a running noise floor estimate goes on over the segments, it
+            # isn't saved, so an interrupted one starts over from the first row
+            first_row = store.count
+            if self.nf_estimator.stateful and not store.is_complete():
+                first_row = 0
+            self.nf_estimator.reset()
+
+            # checkpoint_rows rows at a time, so a killed run loses at most that many
+            for first in range(first_row, num_rows, store.checkpoint_rows):
+                last = min(first + store.checkpoint_rows, num_rows)
+                start, stop = self.get_row_shots(first, last, num_frames)
+                self.spectrogram(data[start:stop], out=store.data[first:last],
+                                 psd_out=None if store.psd is None else store.psd[first:last], reset=False)
+                with self.profiler.stage('sink'):
+                    store.checkpoint(last)
+
+            self.sf = store.data
+            if num_rows:
+                self.snr = self.sf[-1]
+
+            return self.sf
+        else:
+            raise Exception("SpectralAnalysis:UnsupportedProcessor\n"
+                            "No backend available for processor '{0}'".format(self.processor))
+
+    def iter_sound_field(self, batch_rows=256, all_bands=False):
+        """
+        Compute the sound field of shot_rng in this process, batch_rows
+        rows at a time into one buffer that every batch reuses, for
+        consumers that don't keep the rows, e.g. EventDetector.  A
+        running noise floor estimate goes on over the batches
+        :param batch_rows: Rows per batch
+        :param all_bands: Yield the SNR of every band, see spectrogram
+        :return: generator of (first row, (rows x channels) SNR), the
+                 array is overwritten by the next batch
+        """
+        data = self.get_roi_data()
+        num_frames = self.get_num_frames(data.shape[0])
+        num_rows = self.get_num_rows(num_frames)
+        batch_rows = max(min(int(batch_rows), num_rows), 1)
+
+        if all_bands:
+            out = numpy.zeros((batch_rows, len(self.bin_rng), self.num_samples), dtype=self.get_dtype())
+        else:
+            out = numpy.zeros((batch_rows, self.num_samples), dtype=self.get_dtype())
+        self.profiler.set_buffer('sink', out.nbytes)
+
+        self.nf_estimator.reset()
+        for first in range(0, num_rows, batch_rows):
+            last = min(first + batch_rows, num_rows)
+            start, stop = self.get_row_shots(first, last, num_frames)
+            yield first, self.spectrogram(data[start:stop], out=out[:last - first], all_bands=all_bands,
+                                          reset=False)
+
+    def process_chunk(self, iteration, chunk):
+        """
+        Perform fft analysis on a data chunk
+        :return: SNR of the PSD stack ending at this frame,
+                 None if the frame doesn't end a stack
+        """
+        # loop through all frames and run fft on each frame
+        frame = iteration - 1
+
+        # calculate the current shot range in this frame
+        t = self.shot_rng[0] + (frame - 1) * self.rolling_step
+        self.frame_shot_rng = [t + 1, t + self.frame_length]
+
+        # generate Raw PSD
+        with self.profiler.stage('fft', frames=1):
+            psd = self.get_psd(chunk)
+
+        # stacking psd
+        if self.psd_stacking_factor == 1:
+            apsd = psd
+        else:
+            if frame == 1 or self.psd_stack is None:
+                self.psd_stack = PsdStack(self.psd_stacking_factor)
+            with self.profiler.stage('stack'):
+                apsd = self.psd_stack.add(psd)
+
+        if frame == 1:
+            self.nf_estimator.reset()
+
+        # estimate noise floor level
+        if frame % self.psd_stacking_factor == 0 or frame == self.num_frames:
+            with self.profiler.stage('noise_floor'):
+                self.noise_floor = self.get_noise_floor(apsd)
+
+            # calculate SNR of every band, the sound field shows sf_band
+            self.apsd = apsd
+            with self.profiler.stage('snr'):
+                self.snr = self.get_snr(apsd, self.noise_floor)
+            self.sf = self.snr[self.sf_band]
 
             # clear noise floor vector
             self.noise_floor = []
 
-        return self.sf
\ No newline at end of file
+            return self.sf
+
+        return None
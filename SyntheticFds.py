@@ -0,0 +1,165 @@
+"""
+Write synthetic FDS files, e.g. to try the follow mode of Program
+without an interrogator or as reproducible inputs of Benchmark.  Shots
+are appended in real time at the PRF unless --fast is given:
+
+    python SyntheticFds.py out.fds --channels 64 --prf 2000 --seconds 60
+    python SyntheticFds.py out.fds --fast --seed 1 --tone 150 300 10 20
+"""
+
+import argparse
+import time
+
+import numpy
+
+from ReadFDS import get_data_type
+
+
+def make_header(num_channels, num_shots, prf=2000, encoding='uint16', values=None):
+    """
+    Text of an FDS header that FdsHeader can read, the data section
+    starts right after it
+    :param num_channels: Samples per shot (DataLocusCount)
+    :param num_shots: Shots the file will hold (EndShots)
+    :param prf: Laser pulse rate in Hz
+    :param encoding: DataEncoding of the samples
+    :param values: Optional dict of header values to add or replace
+    :return: str
+    """
+    fields = [
+        ('acquisition.laserPulseRate', str(prf)),
+        ('acquisition.alazar.channelA.inputRange', '2V'),
+        ('EndShots', str(num_shots)),
+        ('PositionOfFirstSample_m', '0'),
+        ('TimeOfFirstSample', '2014-07-08T17:29:59.0000000Z'),
+    ]
+    fields = [(key, (values or {}).get(key, value)) for key, value in fields]
+    fields += [(key, value) for key, value in sorted((values or {}).items()) if key not in dict(fields)]
+
+    # the sizes are fixed width, so the header length doesn't depend on them
+    def build(size):
+        lines = ['FDSVersion = 1',
+                 'DataStartLoc = {0:010d}'.format(size),
+                 # FdsHeader reads lines up to the size of the last section
+                 # and drops the line after them, EndOfHeader
+                 'HeaderSectionSizes_Bytes = [{0:010d} 0 {0:010d}]'.format(size),
+                 'HeaderSectionLabels = [Header Padding Header]',
+                 'DataLocusCount = {0}'.format(num_channels),
+                 'DataEncoding = {0}'.format(encoding),
+                 'HeaderSize_Bytes = {0:010d}'.format(size)]
+        lines += ['{0} = {1}'.format(key, value) for key, value in fields]
+        lines.append('EndOfHeader')
+
+        return '\n'.join(lines) + '\n'
+
+    return build(len(build(0)))
+
+
+def make_shots(first_shot, num_shots, num_channels, prf=2000, tone_hz=100, speed=0.5, seed=None,
+               amplitude=3000, noise=1000, tones=None):
+    """
+    Offset binary shots of noise with a tone whose source moves along the
+    fiber and back, so the sound field shows a track, and optionally
+    tones that stay in the same channels
+    :param first_shot: Index of the first shot since the start of the file,
+                       keeps the tone and the source position continuous
+    :param num_shots: Number of shots
+    :param num_channels: Samples per shot
+    :param prf: Laser pulse rate in Hz
+    :param tone_hz: Frequency of the moving tone
+    :param speed: Channels the source moves per second
+    :param seed: Seed of the noise, None for a different one every call
+    :param amplitude: Peak of the moving tone in counts, 0 for none
+    :param noise: Standard deviation of the white noise in counts
+    :param tones: Optional list of (frequency in Hz, amplitude in counts,
+                  first channel, last channel) of fixed tones, channels
+                  0-based and inclusive
+    :return: (shots x channels) uint16 array
+    """
+    rng = numpy.random.RandomState(seed)
+
+    t = (first_shot + numpy.arange(num_shots))[:, numpy.newaxis] / float(prf)
+    channel = numpy.arange(num_channels)
+
+    shots = 32768 + noise * rng.standard_normal((num_shots, num_channels))
+
+    if amplitude:
+        # back and forth between the ends of the fiber
+        position = (speed * t) % (2 * num_channels)
+        position = numpy.minimum(position, 2 * num_channels - position)
+        gain = numpy.exp(-0.5 * ((channel - position) / 2.0) ** 2)
+
+        shots += amplitude * gain * numpy.sin(2 * numpy.pi * tone_hz * t)
+
+    for frequency, tone_amplitude, first, last in tones or []:
+        shots[:, first:last + 1] += tone_amplitude * numpy.sin(2 * numpy.pi * frequency * t)
+
+    return numpy.clip(shots, 0, 65535).astype(numpy.uint16)
+
+
+def write_file(path, num_channels, num_shots, prf=2000, block=None, realtime=False, encoding='uint16',
+               seed=None, values=None, **signal):
+    """
+    Write a synthetic FDS file a block of shots at a time
+    :param path: File to create, overwritten if it exists
+    :param num_channels: Samples per shot
+    :param num_shots: Total number of shots
+    :param prf: Laser pulse rate in Hz
+    :param block: Shots per write, defaults to a tenth of a second
+    :param realtime: Wait between the blocks like an acquisition at the PRF
+    :param encoding: DataEncoding of the samples
+    :param seed: Seed of the noise, the same seed and block size give
+                 the same file, None for a different file every time
+    :param values: Optional dict of header values to add or replace
+    :param signal: Options of make_shots, e.g. amplitude, noise or tones
+    :return:
+    """
+    block = block or max(prf // 10, 1)
+    dtype = get_data_type(encoding)
+    start = time.time()
+
+    with open(path, 'wb') as f:
+        f.write(make_header(num_channels, num_shots, prf, encoding, values).encode('ascii'))
+        f.flush()
+
+        for first in range(0, num_shots, block):
+            count = min(block, num_shots - first)
+            shots = make_shots(first, count, num_channels, prf,
+                               seed=None if seed is None else [seed, first], **signal)
+            if dtype != numpy.uint16:
+                # volts for the float encodings, the 2V range of the header
+                shots = ((shots.astype(numpy.float64) - 32768) * (2.0 / 32768)).astype(dtype)
+
+            f.write(shots.tobytes())
+            f.flush()
+
+            if realtime:
+                delay = start + float(first + count) / prf - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic FDS file')
+    parser.add_argument('path', help='FDS file to create')
+    parser.add_argument('--channels', type=int, default=64, help='samples per shot')
+    parser.add_argument('--prf', type=int, default=2000, help='laser pulse rate in Hz')
+    parser.add_argument('--seconds', type=float, default=60, help='length of the capture')
+    parser.add_argument('--encoding', default='uint16', help='DataEncoding of the samples')
+    parser.add_argument('--fast', action='store_true', help="write as fast as possible, don't wait for the PRF")
+    parser.add_argument('--seed', type=int, help='seed of the noise, for the same file every time')
+    parser.add_argument('--amplitude', type=float, default=3000, help='peak of the moving tone in counts')
+    parser.add_argument('--noise', type=float, default=1000, help='standard deviation of the noise in counts')
+    parser.add_argument('--tone', type=float, nargs=4, action='append', default=[],
+                        metavar=('HZ', 'AMPLITUDE', 'FIRST', 'LAST'),
+                        help='fixed tone in channels FIRST to LAST, 0-based, can be repeated')
+    args = parser.parse_args()
+
+    tones = [(hz, amplitude, int(first), int(last)) for hz, amplitude, first, last in args.tone]
+    write_file(args.path, args.channels, int(args.seconds * args.prf), args.prf,
+               realtime=not args.fast, encoding=args.encoding, seed=args.seed,
+               amplitude=args.amplitude, noise=args.noise, tones=tones)
+
+
+if __name__ == '__main__':
+    main()